@@ -5,69 +5,141 @@ Written by Emilio Monti <emilmont@gmail.com>
 from bintools.elf import ELF
 from bintools.elf.enums import ELFCLASS
 from bintools.elf.structs import StringTable
+from bintools.utils import lazy_property
 
-from bintools.dwarf.stream import DwarfStream
+from bintools.dwarf.stream import DwarfStream, MAX_EXPRESSIONS
 from bintools.dwarf.abbrev import AbbrevLoader
-from bintools.dwarf.info import DebugInfoLoader
-from bintools.dwarf.line import StatementProgramLoader
-from bintools.dwarf.pubnames import PubNamesLoader
-from bintools.dwarf.aranges import ARangesLoader
+from bintools.dwarf.info import DebugInfoLoader, TypeNameIndex
+from bintools.dwarf.line import StatementProgramLoader, SourceFileIndex
+from bintools.dwarf.pubnames import PubNamesLoader, PubTypesLoader
+from bintools.dwarf.aranges import ARangesLoader, CURangesIndex
 from bintools.dwarf.ranges import RangesLoader
 from bintools.dwarf.frame import FrameLoader
 from bintools.dwarf.loc import LocationLoader
+from bintools.dwarf.variables import VariableIndex
+from bintools.dwarf.cache import IndexCache
 
 
 class DWARF(ELF, DwarfStream):
-    def __init__(self, path, addr_size=4):
-        ELF.__init__(self, path)
+    def __init__(self, path, addr_size=4, use_mmap=False, cache_dir=None,
+                 max_line_tables=None, max_expressions=MAX_EXPRESSIONS):
+        """
+        With *cache_dir*, the CU index, the DIE trees and the line tables are
+        kept in an on-disk IndexCache, and reused by later runs on the same
+        ELF file. The cache is read with pickle: *cache_dir* must be trusted.
+        With *max_line_tables*, at most that many decoded line tables are
+        kept in memory, the least recently used ones are decoded again (or
+        read from the IndexCache) when needed.
+        At most *max_expressions* location expressions are interned, see
+        DwarfStream.read_expression.
+        """
+        ELF.__init__(self, path, use_mmap)
         if self.bits == ELFCLASS.ELFCLASS64:
             addr_size = 8
-        DwarfStream.__init__(self, addr_size)
+        DwarfStream.__init__(self, addr_size, max_expressions)
+        self.max_line_tables = max_line_tables
         
-        # DEBUG STRING TABLE
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = IndexCache(cache_dir).open(self, path)
+    
+    # Every section loader is created on first access, so that tools only
+    # pay for the sections they actually use.
+    
+    # DEBUG STRING TABLE
+    @lazy_property
+    def debug_str(self):
         debug_str = self.sect_dict['.debug_str']
-        self.debug_str = StringTable(self.io, debug_str.offset, debug_str.size)
-        
-        # DEBUG LINE
-        self.stmt = StatementProgramLoader(self)
-        
-        # DEBUG ABBREV
-        self.abbrev = AbbrevLoader(self)
-        
-        # DEBUG INFO
-        self.info = DebugInfoLoader(self)
-        
-        # DEBUG PUBNAMES
+        return StringTable(self.io, debug_str.offset, debug_str.size, self.strings)
+    
+    # DEBUG LINE
+    @lazy_property
+    def stmt(self):
+        return StatementProgramLoader(self, self.max_line_tables)
+    
+    # DEBUG ABBREV
+    @lazy_property
+    def abbrev(self):
+        return AbbrevLoader(self)
+    
+    # DEBUG INFO
+    @lazy_property
+    def info(self):
+        return DebugInfoLoader(self)
+    
+    # DEBUG PUBNAMES
+    @lazy_property
+    def pubnames(self):
         if '.debug_pubnames' in self.sect_dict:
-          self.pubnames = PubNamesLoader(self)
-        else:
-          self.pubnames = None
-        
-        # DEBUG ARANGES
-        self.aranges = ARangesLoader(self)
-        
-        # DEBUG RANGES
-        self.ranges = RangesLoader(self)
-        
-        # DEBUG FRAME
+            return PubNamesLoader(self)
+        return None
+    
+    # DEBUG PUBTYPES
+    @lazy_property
+    def pubtypes(self):
+        if '.debug_pubtypes' in self.sect_dict:
+            return PubTypesLoader(self)
+        return None
+    
+    # Global type name index
+    @lazy_property
+    def type_index(self):
+        return TypeNameIndex(self)
+    
+    # DEBUG ARANGES
+    @lazy_property
+    def aranges(self):
+        if '.debug_aranges' in self.sect_dict:
+            return ARangesLoader(self)
+        return None
+    
+    # Address -> CU index: .debug_aranges, or the CU ranges without it
+    @lazy_property
+    def cu_ranges(self):
+        if self.aranges is not None:
+            return self.aranges
+        return CURangesIndex(self)
+    
+    # DEBUG RANGES
+    @lazy_property
+    def ranges(self):
+        return RangesLoader(self)
+    
+    # DEBUG FRAME
+    @lazy_property
+    def frame(self):
         if '.debug_frame' in self.sect_dict:
-            self.frame = FrameLoader(self)
-        else:
-            self.frame = None
-        
-        # DEBUG LOC
-        #if '.debug_loc' in self.sect_dict:
-        #    self.loc = LocationLoader(self)
-        #else:
-        #    self.loc = None
-        self.loc = None
+            return FrameLoader(self)
+        return None
+    
+    # DEBUG LOC
+    @lazy_property
+    def loc(self):
+        if '.debug_loc' in self.sect_dict:
+            return LocationLoader(self)
+        return None
+    
+    # Variable scope indexes, by CU offset, built on first lookup in a CU
+    @lazy_property
+    def variable_indexes(self):
+        return {}
+    
+    # Source file index, over all the CUs
+    @lazy_property
+    def source_files(self):
+        return SourceFileIndex(self)
     
     # Lookup by location
     def get_addr_by_loc(self, filename, line):
-        cu = self.info.get_cu_by_filename(filename)
-        lines = self.stmt.get(cu)
-        file_index = lines.get_file_index(filename)
-        return lines.get_addr_by_loc(file_index, line)
+        # The CU compiled from filename first, then those including it
+        candidates = self.source_files.find(filename)
+        candidates.sort(key=lambda candidate: candidate[0].name != filename)
+        for cu, file_index in candidates:
+            try:
+                return self.stmt.get(cu).get_addr_by_loc(file_index, line)
+            except KeyError:
+                pass
+        raise KeyError('The given location %s:%d is not in the line tables' % (filename, line))
     
     # Lookup by symbol
     def get_loc_by_sym(self, symname):
@@ -83,12 +155,54 @@ class DWARF(ELF, DwarfStream):
         lines = self.stmt.get(die.cu)
         return lines.get_addr_by_loc(file_index, decl_line)
     
+    # Lookup by type name
+    def get_type_die(self, name):
+        return self.type_index.get_die(name)
+    
     # Lookup by address
     def get_loc_by_addr(self, addr):
-        cu = self.aranges.get_cu_by_addr(addr)
+        cu = self.cu_ranges.get_cu_by_addr(addr)
         lines = self.stmt.get(cu)
         return lines.get_loc_by_addr(addr)
     
+    def get_variables_by_addr(self, addr):
+        """
+        Return the (Variable, Expression) of the variables in scope at *addr*,
+        in DIE order; the Expression is None where a variable has no
+        location at *addr*, for instance when it is optimized out.
+        """
+        cu = self.cu_ranges.get_cu_by_addr(addr)
+        if cu.overall_offset not in self.variable_indexes:
+            self.variable_indexes[cu.overall_offset] = VariableIndex(cu)
+        return self.variable_indexes[cu.overall_offset].get_variables_by_addr(addr)
+    
+    def symbolize_many(self, addresses):
+        """
+        Return the (file, line, column, function) location of each of the
+        *addresses*, in the same order, or None for the addresses not covered
+        by the line tables; function is None outside the known functions.
+        The distinct addresses are resolved in increasing order, in one sweep
+        of the address ranges of the CUs and of their line sequences.
+        """
+        locs = {}
+        groups = self.cu_ranges.group_by_cu(sorted(set(addresses)))
+        for cu_offset, addrs in groups:
+            if cu_offset is None:
+                continue
+            cu = self.info.get_cu_by_offset(cu_offset)
+            lines = self.stmt.get(cu)
+            m = lines.matrix
+            paths = {}
+            for addr, row in zip(addrs, lines.get_rows_by_addrs(addrs)):
+                if row is None:
+                    continue
+                f = m.files[row]
+                if f not in paths:
+                    paths[f] = cu.get_file_path(f)
+                locs[addr] = (paths[f], m.lines[row], m.columns[row],
+                              cu.get_function_by_addr(addr))
+        return [locs.get(addr) for addr in addresses]
+    
     def __str__(self):
         return '\n'.join(map(str,
                 [self.info, self.pubnames, self.aranges, self.frame, self.loc]))
@@ -2,52 +2,103 @@
 Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
-from bintools.dwarf.stream import SectionCache
+from bintools.dwarf.stream import SectionCache, read_uleb128
 from bintools.dwarf.enums import DW_AT, DW_FORM, DW_TAG
 
 
+# Attributes whose block forms hold a DWARF expression
+EXPRESSION_ATTRIBS = ('location', 'data_member_location', 'frame_base')
+
+# CU relative reference forms, usable to jump to a DIE sibling
+SIBLING_FORMS = ('ref1', 'ref2', 'ref4', 'ref8', 'ref_udata')
+
+
 class AttribForm(object):
     def __init__(self, name_id, form):
+        """
+        Attribute *name_id* (DW_AT) in *form* (DW_FORM), with the shared
+        name and form_name strings
+        """
         self.name_id = name_id
         self.form = form
+        self.name = DW_AT[name_id]
+        self.form_name = DW_FORM[form]
 
     def __str__(self):
-        return '%s: %s' % (DW_AT[self.name_id], DW_FORM[self.form])
+        return '%s: %s' % (self.name, self.form_name)
 
 
 class Abbrev(object):
-    def __init__(self, stream):
-        self.index = stream.ULEB128()
-        if self.index == 0:
-            return
-        
-        self.tag = stream.ULEB128()
-        self.has_children = stream.u08()
-        
-        self.attrib_forms = []
-        while True:
-            name_id = stream.ULEB128()
-            form = stream.ULEB128()
-            if (name_id == 0) and (form == 0):
-                break
-            self.attrib_forms.append(AttribForm(name_id, form))
+    def __init__(self, index, tag, has_children, attrib_forms):
+        self.index = index
+        self.tag = tag
+        self.has_children = has_children
+        self.attrib_forms = attrib_forms
+
+    def compile(self, dwarf):
+        """
+        Precompute how to decode the DIEs using this abbreviation:
+        readers holds one reader per attribute and attr_names their names,
+        to key the attribute dicts; to skip the attributes, each
+        (size, skip) of skippers jumps over a run of fixed-size forms, then over
+        a variable-size one, and size is the size of the trailing fixed forms.
+        If the DW_AT_sibling value is at a fixed position, sibling holds its
+        (position, reader), so that the DIE children can be jumped over.
+        """
+        readers = []
+        skippers = []
+        size = 0
+        self.sibling = None
+        for attrib_form in self.attrib_forms:
+            form = attrib_form.form
+            if (attrib_form.name == 'sibling' and not skippers and
+                attrib_form.form_name in SIBLING_FORMS):
+                self.sibling = (size, dwarf.form_readers[form])
+            if attrib_form.name in EXPRESSION_ATTRIBS and form in dwarf.expr_block_readers:
+                readers.append(dwarf.expr_block_readers[form])
+            else:
+                readers.append(dwarf.form_readers[form])
+
+            if form in dwarf.form_sizes:
+                size += dwarf.form_sizes[form]
+            else:
+                skippers.append((size, dwarf.form_skippers[form]))
+                size = 0
+        self.size = size
+        self.attr_names = tuple(attrib_form.name for attrib_form in self.attrib_forms)
+        self.readers = tuple(readers)
+        self.skippers = tuple(skippers)
 
     def __str__(self):
         tag = '\n[%s]' % DW_TAG[self.tag]
         return '\n'.join(map(str, [tag] + self.attrib_forms)) 
 
 
-def abbrev_dict(dwarf, offset):
+def abbrev_dict(dwarf, buf, pos, offset):
+    u08 = dwarf.decoder.u08
     abbrevs = {}
     while True:
-        a = Abbrev(dwarf)
-        if a.index == 0:
+        index, pos = read_uleb128(buf, pos)
+        if index == 0:
             break
-        abbrevs[a.index] = a
+        
+        tag, pos = read_uleb128(buf, pos)
+        has_children, pos = u08(buf, pos)
+        
+        attrib_forms = []
+        while True:
+            name_id, pos = read_uleb128(buf, pos)
+            form, pos = read_uleb128(buf, pos)
+            if (name_id == 0) and (form == 0):
+                break
+            attrib_forms.append(AttribForm(name_id, form))
+        abbrevs[index] = Abbrev(index, tag, has_children, attrib_forms)
+        abbrevs[index].compile(dwarf)
     
     return abbrevs
 
 
 class AbbrevLoader(SectionCache):
-    def __init__(self, dwarf):
-        SectionCache.__init__(self, dwarf, '.debug_abbrev', abbrev_dict)
+    def __init__(self, dwarf, max_entries=None):
+        SectionCache.__init__(self, dwarf, '.debug_abbrev', abbrev_dict,
+                              max_entries=max_entries)
@@ -3,42 +3,44 @@ Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
 from bintools.dwarf.stream import SectionLoader
+from bintools.utils import IntegerIntervals, lazy_property
 
 
 class ARange(object):
-    def __init__(self, dwarf):
-        self.address = dwarf.read_addr()
-        self.length = dwarf.read_addr()
+    def __init__(self, address, length):
+        self.address = address
+        self.length = length
     
     def __str__(self):
         return 'starts at 0x%08x, length of %d' % (self.address, self.length)
 
 
 class ARanges(object):
-    def __init__(self, dwarf, offset):
-        start = dwarf.io.tell()
-        length = dwarf.u32()
-        stop = dwarf.io.tell() + length
-        dwarf.check_version()
+    def __init__(self, dwarf, buf, pos, offset):
+        start = pos
+        length, pos = dwarf.decoder.u32(buf, pos)
+        self.stop = stop = pos + length
+        ver, pos = dwarf.check_version(buf, pos)
         
-        self.info_offset = dwarf.u32()
-        self.addr_size = dwarf.u08()
-        self.segm_size = dwarf.u08()
+        self.info_offset, pos = dwarf.decoder.u32(buf, pos)
+        self.addr_size, pos = dwarf.decoder.u08(buf, pos)
+        self.segm_size, pos = dwarf.decoder.u08(buf, pos)
 
         # Tuples need to be aligned to the tuple size (two words).
         # Note that the alignment needs to be for offset from start of the
         # section and not from the start of the file.
         alignment = 2 * self.addr_size
-        current_offset = dwarf.io.tell() - start
+        current_offset = pos - start
         aligned_offset = (current_offset + (alignment - 1)) & ~(alignment - 1)
-        dwarf.io.seek(start + aligned_offset)
+        pos = start + aligned_offset
         
         self.aranges = []
-        while dwarf.io.tell() < stop:
-            ar = ARange(dwarf)
-            if ar.address == 0 and ar.length == 0:
+        while pos < stop:
+            address, pos = dwarf.read_addr(buf, pos)
+            length, pos = dwarf.read_addr(buf, pos)
+            if address == 0 and length == 0:
                 return
-            self.aranges.append(ar)
+            self.aranges.append(ARange(address, length))
     
     def contains(self, addr):
         for range in self.aranges:
@@ -50,12 +52,86 @@ class ARanges(object):
         return '\n'.join(['CU: %d' % self.info_offset]+list(map(str, self.aranges)))
 
 
-class ARangesLoader(SectionLoader):
+def arangesEntry(dwarf, buf, pos, offset):
+    entry = ARanges(dwarf, buf, pos, offset)
+    return entry, entry.stop
+
+
+class CUIntervalsLookup(object):
+    """
+    Lookup of the CUs by address through *intervals*, disjoint (first
+    address, last address, CU offset) IntegerIntervals
+    """
+    def get_cu_by_addr(self, addr):
+        cu_offset = self.intervals.get(addr)
+        if cu_offset is None:
+            raise KeyError('The given address 0x%x is not within any CU range' % addr)
+        return self.dwarf.info.get_cu_by_offset(cu_offset)
+    
+    def group_by_cu(self, addrs):
+        """
+        Split the sorted *addrs* in runs of addresses of the same CU, in one
+        sweep of the intervals. Return a list of (CU offset, addresses), with
+        None as the CU offset of the addresses outside any range.
+        """
+        intervals = list(self.intervals)
+        groups = []
+        j = 0
+        for addr in addrs:
+            while j < len(intervals) and intervals[j][1] < addr:
+                j += 1
+            cu_offset = None
+            if j < len(intervals) and intervals[j][0] <= addr:
+                cu_offset = intervals[j][2]
+            
+            if not groups or groups[-1][0] != cu_offset:
+                groups.append((cu_offset, []))
+            groups[-1][1].append(addr)
+        return groups
+
+
+class ARangesLoader(SectionLoader, CUIntervalsLookup):
     def __init__(self, dwarf):
-        SectionLoader.__init__(self, dwarf, '.debug_aranges', ARanges)
+        SectionLoader.__init__(self, dwarf, '.debug_aranges', arangesEntry)
     
-    def get_cu_by_addr(self, addr):
-        for entry in self.entries:
-            if entry.contains(addr):
-                return self.dwarf.info.get_cu_by_offset(entry.info_offset)
-        raise KeyError('The given address 0x%x is not within any CU range' % addr)
+    @lazy_property
+    def intervals(self):
+        """
+        Flat index of all the address ranges. Where ranges overlap, as they
+        can after the linker merged or discarded sections, the first entry
+        wins.
+        """
+        intervals = IntegerIntervals()
+        intervals.add_intervals([(r.address, r.address + r.length - 1, entry.info_offset)
+                                 for entry in self.entries for r in entry.aranges])
+        return intervals
+
+
+class CURangesIndex(CUIntervalsLookup):
+    def __init__(self, dwarf):
+        """
+        Replacement of ARangesLoader for the ELF files without
+        .debug_aranges: the address ranges of each CU are those of its root
+        DIE, decoded with the CU header, or else those of its top level
+        functions. Where ranges overlap, the first CU wins.
+        """
+        self.dwarf = dwarf
+        intervals = None
+        if dwarf.cache is not None:
+            intervals = dwarf.cache.get('cu-ranges')
+        
+        if intervals is None:
+            intervals = []
+            for cu in dwarf.info.cus:
+                pc_ranges = cu.pc_ranges
+                if not pc_ranges:
+                    if cu.function_starts is None:
+                        cu.build_function_index()
+                    pc_ranges = [(low, high) for low, high, name in cu.function_ranges]
+                intervals.extend((low, high - 1, cu.overall_offset)
+                                 for low, high in pc_ranges)
+            if dwarf.cache is not None:
+                dwarf.cache.put('cu-ranges', intervals)
+        
+        self.intervals = IntegerIntervals()
+        self.intervals.add_intervals(intervals)
@@ -0,0 +1,236 @@
+"""
+Persistent on-disk cache of the DWARF indexes, shared by the tools working
+repeatedly on the same ELF files.
+"""
+import os
+import sys
+import errno
+import hashlib
+import tempfile
+from array import array
+from binascii import hexlify
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Bump on every change of the cached data layout
+CACHE_VERSION = 4
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+
+def pack_array(a):
+    """
+    Picklable compact form of the array *a*
+    """
+    if hasattr(a, 'tobytes'):
+        return a.typecode, a.tobytes()
+    return a.typecode, a.tostring()
+
+def unpack_array(packed):
+    typecode, data = packed
+    a = array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    return a
+
+
+def build_id(elf):
+    """
+    Return the hexadecimal GNU build-id of *elf*, or None
+    """
+    if '.note.gnu.build-id' not in elf.sect_dict:
+        return None
+    buf, pos = elf.get_section_buffer(elf.sect_dict['.note.gnu.build-id'])
+    u32 = elf.decoder.u32
+    name_size, pos = u32(buf, pos)
+    desc_size, pos = u32(buf, pos)
+    note_type, pos = u32(buf, pos)
+    pos += (name_size + 3) & ~3
+    return hexlify(bytes(buf[pos:pos+desc_size])).decode('ascii')
+
+def ignore_missing(function, *args):
+    """
+    Return function(*args), or None if the file it works on does not exist:
+    other processes using the cache remove entries concurrently
+    """
+    try:
+        return function(*args)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def file_stat(path):
+    """
+    Return the size and modification time (in ns) of *path*, as text
+    """
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None: # Python 2
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return '%d %d' % (st.st_size, mtime_ns)
+
+def file_hash(path):
+    """
+    Return the SHA-1 of the contents of *path*
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class IndexCache(object):
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """
+        Cache of DWARF indexes in *directory*, one subdirectory per ELF file,
+        named after its build-id (or its path) and the Python major version.
+        Once the cache grows past *max_size* bytes, the least recently used
+        subdirectories are evicted.
+        The indexes are stored with pickle, which can run arbitrary code on
+        loading: *directory* must only be writable by trusted users.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def open(self, elf, path):
+        """
+        Return the IndexCacheEntry of the ELF *elf*, read from *path*
+        """
+        key = build_id(elf)
+        source = None
+        if key is None:
+            # One entry per path, checked against the file on every open
+            source = path
+            key = 'path-' + hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        name = '%s-py%d' % (key, sys.version_info[0])
+        entry = IndexCacheEntry(os.path.join(self.directory, name), source)
+        self.evict(keep=name)
+        return entry
+    
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries (except *keep*) until the
+        cache fits in max_size. The entries and files removed meanwhile by
+        other processes are skipped.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, name)
+            if not os.path.isdir(entry_dir):
+                continue
+            files = ignore_missing(os.listdir, entry_dir)
+            mtime = ignore_missing(os.path.getmtime, entry_dir)
+            if files is None or mtime is None:
+                continue
+            size = sum(ignore_missing(os.path.getsize, os.path.join(entry_dir, f)) or 0
+                       for f in files)
+            entries.append((mtime, name, size))
+            total += size
+        
+        entries.sort()
+        for mtime, name, size in entries:
+            if total <= self.max_size:
+                break
+            if name != keep:
+                remove_entry(os.path.join(self.directory, name))
+                total -= size
+
+
+def remove_entry(entry_dir):
+    """
+    Remove the directory *entry_dir* and its files, unless another process
+    removed it, or wrote a new file in it, meanwhile
+    """
+    for f in ignore_missing(os.listdir, entry_dir) or []:
+        ignore_missing(os.remove, os.path.join(entry_dir, f))
+    try:
+        os.rmdir(entry_dir)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTEMPTY):
+            raise
+
+
+class IndexCacheEntry(object):
+    def __init__(self, directory, source=None):
+        """
+        Cached indexes of one ELF file, as one pickle file per index name.
+        Stale entries, written with another CACHE_VERSION, are removed.
+        With *source*, the path of the ELF file, the entry is also removed
+        when the file contents change: the size and modification time are
+        compared first, the contents are only hashed when they differ.
+        """
+        self.directory = directory
+        if os.path.isdir(directory):
+            if self.read('version') != str(CACHE_VERSION):
+                remove_entry(directory)
+        self.create()
+        
+        if source is not None:
+            stat = file_stat(source)
+            if self.read('stat') != stat:
+                digest = file_hash(source)
+                if self.read('sha1') != digest:
+                    remove_entry(directory)
+                    self.create()
+                    self.write(os.path.join(directory, 'sha1'), digest.encode('ascii'))
+                self.write(os.path.join(directory, 'stat'), stat.encode('ascii'))
+        
+        # Mark as recently used, for IndexCache.evict
+        ignore_missing(os.utime, directory, None)
+    
+    def create(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError: # created meanwhile by another process
+                pass
+            self.write(os.path.join(self.directory, 'version'),
+                       str(CACHE_VERSION).encode('ascii'))
+    
+    def read(self, name):
+        """
+        Return the text file *name* of the entry, or None
+        """
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return f.read()
+        except IOError:
+            return None
+    
+    def write(self, path, data):
+        # Write then rename, so that concurrent readers (and writers of the
+        # same index) never see a partial file. Nothing is written if another
+        # process evicted the entry meanwhile.
+        tmp = ignore_missing(tempfile.mkstemp, '', 'tmp', self.directory)
+        if tmp is None:
+            return
+        fd, tmp_path = tmp
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        ignore_missing(os.rename, tmp_path, path)
+    
+    def get(self, name):
+        """
+        Return the index *name*, or None if it is not cached
+        """
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+    
+    def put(self, name, value):
+        self.write(os.path.join(self.directory, name),
+                   pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
@@ -283,6 +283,9 @@ class DW_LNS(object):
     set_basic_block = 7
     const_add_pc = 8
     fixed_advance_pc = 9
+    set_prologue_end = 10
+    set_epilogue_begin = 11
+    set_isa = 12
 
 
 class DW_LNE(object):
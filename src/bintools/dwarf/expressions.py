@@ -4,6 +4,7 @@ Written by Emilio Monti <emilmont@gmail.com>
 """
 from bintools.elf.exception import *
 from bintools.dwarf.enums import DW_OP
+from bintools.utils import lazy_property
 
 
 class Instruction(object):
@@ -98,214 +99,374 @@ DW_OP_OPERANDS = {
 }
 
 
+class Machine(object):
+    """
+    State of the debugged program, as read by Expression.evaluate: the
+    subclasses provide the registers (by DWARF number), the frame base of
+    the current function, its canonical frame address, and the memory.
+    What a machine does not provide cannot be evaluated, as for the
+    unsupported operations.
+    """
+    def read_reg(self, reg):
+        raise ParseError("Cannot evaluate register %d without a machine" % reg)
+    
+    def read_fbreg(self):
+        raise ParseError("Cannot evaluate the frame base without a machine")
+    
+    def read_cfa(self):
+        raise ParseError("Cannot evaluate the call frame address without a machine")
+    
+    def read_addr(self, addr, size=None, addr_space_id=None):
+        """
+        Return the *size* bytes (an address by default) value at *addr*
+        """
+        raise ParseError("Cannot read memory at 0x%x without a machine" % addr)
+
+NO_MACHINE = Machine()
+
+
+# Operation handlers: handler(stack, operand_1, operand_2, machine) pops
+# its arguments from the stack and pushes its result. The branches return
+# the index of the next instruction, the other operations None.
+
+def op_push(stack, operand_1, operand_2, machine):
+    stack.append(operand_1)
+
+def op_nop(stack, operand_1, operand_2, machine):
+    pass
+
+# Register Based Addressing
+def op_reg(stack, operand_1, operand_2, machine):
+    stack.append(machine.read_reg(operand_1))
+
+def op_breg(stack, operand_1, operand_2, machine):
+    stack.append(machine.read_reg(operand_2) + operand_1)
+
+def op_fbreg(stack, operand_1, operand_2, machine):
+    stack.append(machine.read_fbreg() + operand_1)
+
+def op_call_frame_cfa(stack, operand_1, operand_2, machine):
+    stack.append(machine.read_cfa())
+
+# Stack Operations
+def op_dup(stack, operand_1, operand_2, machine):
+    stack.append(stack[-1])
+
+def op_drop(stack, operand_1, operand_2, machine):
+    stack.pop()
+
+def op_pick(stack, operand_1, operand_2, machine):
+    stack.append(stack[-1 - operand_1])
+
+def op_over(stack, operand_1, operand_2, machine):
+    stack.append(stack[-2])
+
+def op_swap(stack, operand_1, operand_2, machine):
+    stack[-1], stack[-2] = stack[-2], stack[-1]
+
+def op_rot(stack, operand_1, operand_2, machine):
+    stack[-1], stack[-2], stack[-3] = stack[-2], stack[-3], stack[-1]
+
+def op_deref(stack, operand_1, operand_2, machine):
+    stack[-1] = machine.read_addr(stack[-1])
+
+def op_deref_size(stack, operand_1, operand_2, machine):
+    stack[-1] = machine.read_addr(stack[-1], operand_1)
+
+def op_xderef(stack, operand_1, operand_2, machine):
+    addr = stack.pop()
+    stack[-1] = machine.read_addr(addr, addr_space_id=stack[-1])
+
+def op_xderef_size(stack, operand_1, operand_2, machine):
+    addr = stack.pop()
+    stack[-1] = machine.read_addr(addr, operand_1, stack[-1])
+
+# Arithmetic and Logical Operations: the binary ones apply to the former
+# second entry and the former top entry, in this order
+def op_abs(stack, operand_1, operand_2, machine):
+    stack[-1] = abs(stack[-1])
+
+def op_neg(stack, operand_1, operand_2, machine):
+    stack[-1] = -stack[-1]
+
+def op_not(stack, operand_1, operand_2, machine):
+    stack[-1] = ~stack[-1]
+
+def op_plus_uconst(stack, operand_1, operand_2, machine):
+    stack[-1] += operand_1
+
+def op_and(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] &= top
+
+def op_or(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] |= top
+
+def op_xor(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] ^= top
+
+def op_plus(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] += top
+
+def op_minus(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] -= top
+
+def op_mul(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] *= top
+
+def op_div(stack, operand_1, operand_2, machine):
+    # Signed division, rounding toward zero
+    top = stack.pop()
+    quotient = abs(stack[-1]) // abs(top)
+    stack[-1] = quotient if (stack[-1] < 0) == (top < 0) else -quotient
+
+# The unsigned operations get the address size mask as operand_1
+def op_mod(stack, operand_1, operand_2, machine):
+    top = stack.pop() & operand_1
+    stack[-1] = (stack[-1] & operand_1) % top
+
+def op_shl(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = (stack[-1] << top) & operand_1
+
+def op_shr(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = (stack[-1] & operand_1) >> top
+
+def op_shra(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] >>= top
+
+# Control Flow Operations
+def op_eq(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = 1 if stack[-1] == top else 0
+
+def op_ge(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = 1 if stack[-1] >= top else 0
+
+def op_gt(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = 1 if stack[-1] > top else 0
+
+def op_le(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = 1 if stack[-1] <= top else 0
+
+def op_lt(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = 1 if stack[-1] < top else 0
+
+def op_ne(stack, operand_1, operand_2, machine):
+    top = stack.pop()
+    stack[-1] = 1 if stack[-1] != top else 0
+
+def op_skip(stack, operand_1, operand_2, machine):
+    return operand_1
+
+def op_bra(stack, operand_1, operand_2, machine):
+    if stack.pop() != 0:
+        return operand_1
+    return None
+
+# Handlers by opcode; Expression.program maps the literal, register and
+# branch families itself
+OPERATIONS = dict((DW_OP.name_dict[name], handler) for name, handler in (
+    ('addr', op_push),
+    ('const1u', op_push), ('const1s', op_push),
+    ('const2u', op_push), ('const2s', op_push),
+    ('const4u', op_push), ('const4s', op_push),
+    ('const8u', op_push), ('const8s', op_push),
+    ('constu', op_push), ('consts', op_push),
+    ('regx', op_reg), ('fbreg', op_fbreg),
+    ('call_frame_cfa', op_call_frame_cfa),
+    ('dup', op_dup), ('drop', op_drop), ('pick', op_pick),
+    ('over', op_over), ('swap', op_swap), ('rot', op_rot),
+    ('deref', op_deref), ('deref_size', op_deref_size),
+    ('xderef', op_xderef), ('xderef_size', op_xderef_size),
+    ('abs', op_abs), ('neg', op_neg), ('not', op_not),
+    ('plus_uconst', op_plus_uconst),
+    ('and', op_and), ('or', op_or), ('xor', op_xor),
+    ('plus', op_plus), ('minus', op_minus), ('mul', op_mul),
+    ('div', op_div), ('shra', op_shra),
+    ('eq', op_eq), ('ge', op_ge), ('gt', op_gt),
+    ('le', op_le), ('lt', op_lt), ('ne', op_ne),
+    ('nop', op_nop), ('stack_value', op_nop),
+    ('piece', op_nop), ('bit_piece', op_nop),
+))
+
+# Handlers of the unsigned operations, which wrap at the address size
+ADDRESS_SIZE_OPERATIONS = dict((DW_OP.name_dict[name], handler) for name, handler in (
+    ('mod', op_mod), ('shl', op_shl), ('shr', op_shr),
+))
+
+
 class Expression(object):
-    def __init__(self, dwarf, length):
-        self.instructions = []
-        self.addr_index_dict = {}
+    def __init__(self, dwarf, code):
+        """
+        DWARF expression of the bytes *code*. The instructions are decoded on
+        first access; the streams intern the expressions by code (see
+        DwarfStream.read_expression), so equal ones share one decoding.
+        """
+        self.dwarf = dwarf
+        self.code = code
+    
+    @lazy_property
+    def instructions(self):
+        instructions = []
         
-        start = dwarf.io.tell()
-        i = 0
-        while True:
-            addr = dwarf.io.tell() - start
-            if addr >= length:
-                break
-            
-            opcode = dwarf.u08()
+        code = self.code
+        u08 = self.dwarf.decoder.u08
+        readers = self.dwarf.readers
+        offset = 0
+        while offset < len(code):
+            addr = offset
+            opcode, offset = u08(code, offset)
             if opcode not in DW_OP:
-                previnst = ','.join(str(x) for x in self.instructions)
-                raise ParseError("Unknown DW_OP code: %d (after %s, offset 0x%x)" % (opcode, previnst, dwarf.io.tell()))
-
+                previnst = ','.join(str(x) for x in instructions)
+                raise ParseError("Unknown DW_OP code: %d (after %s, offset 0x%x)" % (opcode, previnst, offset))
+            
             operand_1 = operand_2 = None
             if opcode in DW_OP_OPERANDS:
                 type_1, type_2 = DW_OP_OPERANDS[opcode]
-                operand_1 = dwarf.read_type(type_1)
+                operand_1, offset = readers[type_1](code, offset)
                 if type_2 is not None:
-                    operand_2 = dwarf.read_type(type_2)
+                    operand_2, offset = readers[type_2](code, offset)
             
-            self.instructions.append(Instruction(addr, opcode, operand_1, operand_2))
-            self.addr_index_dict[addr] = i
-            i += 1
+            instructions.append(Instruction(addr, opcode, operand_1, operand_2))
+        return instructions
     
-    @staticmethod
-    def get_values(addr_stack, n=2):
-        values = []
-        for _ in range(n):
-            values.append(addr_stack.pop())
-        return values
+    @lazy_property
+    def addr_index_dict(self):
+        return dict((instruction.addr, i) for i, instruction in enumerate(self.instructions))
     
-    def evaluate(self, base_address=0, machine=None):
-        addr_stack = [base_address]
-        
-        i = 0
-        while True:
-            if i >= len(self.instructions): break
-            
-            op_addr, opcode, operand_1, operand_2 = self.instructions[i].get()
-            
-            # Literal Encodings
-            if opcode >= DW_OP.lit0 and opcode >= DW_OP.lit31:
-                addr_stack.append(opcode - DW_OP.lit0)
-            
-            if opcode in [DW_OP.addr, DW_OP.constu, DW_OP.consts,
-                          DW_OP.const1u, DW_OP.const1s, DW_OP.const2u, DW_OP.const2s,
-                          DW_OP.const4u, DW_OP.const4s, DW_OP.const8u, DW_OP.const8s]:
-                addr_stack.append(operand_1)
-            
-            # Register Based Addressing
-            elif opcode == DW_OP.fbreg:
-                addr_stack.append(self.machine.read_fbreg() + operand_1)
-            
-            elif opcode >= DW_OP.breg0 and opcode <= DW_OP.breg31:
-                reg_index = opcode - DW_OP.breg0
-                addr_stack.append(self.machine.read_reg(reg_index) + operand_1)
-            
+    @lazy_property
+    def program(self):
+        """
+        The instructions compiled for evaluate: a (handler, operand_1,
+        operand_2) tuple per instruction, see OPERATIONS. The literals,
+        registers and branch targets are resolved here, once per Expression.
+        """
+        program = []
+        for instruction in self.instructions:
+            opcode = instruction.opcode
+            operand_1, operand_2 = instruction.operand_1, instruction.operand_2
+            if opcode in OPERATIONS:
+                handler = OPERATIONS[opcode]
+            elif DW_OP.lit0 <= opcode <= DW_OP.lit31:
+                handler, operand_1 = op_push, opcode - DW_OP.lit0
+            elif DW_OP.reg0 <= opcode <= DW_OP.reg31:
+                handler, operand_1 = op_reg, opcode - DW_OP.reg0
+            elif DW_OP.breg0 <= opcode <= DW_OP.breg31:
+                handler, operand_2 = op_breg, opcode - DW_OP.breg0
             elif opcode == DW_OP.bregx:
-                addr_stack.append(self.machine.read_reg(operand_1) + operand_2)
-            
-            # Stack Operations
-            elif opcode == DW_OP.dup:
-                addr_stack.append(addr_stack[-1])
-            
-            elif opcode == DW_OP.drop:
-                addr_stack.pop()
-            
-            elif opcode == DW_OP.pick:
-                index = len(addr_stack) - operand_1 - 1
-                addr_stack.append(addr_stack[index])
-            
-            elif opcode == DW_OP.over:
-                addr_stack.append(addr_stack[-2])
-            
-            elif opcode == DW_OP.swap:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack += [former_top, former_second]
-            
-            elif opcode == DW_OP.rot:
-                top, second, third = Expression.__get_values(addr_stack, 3)
-                addr_stack += [top, third, second]
-            
-            elif opcode == DW_OP.deref:
-                addr = addr_stack.pop()
-                addr_stack.append(self.machine.read_addr(addr))
-            
-            elif opcode == DW_OP.deref_size:
-                addr = addr_stack.pop()
-                addr_stack.append(self.machine.read_addr(addr))
-            
-            elif opcode == DW_OP.xderef:
-                addr = addr_stack.pop()
-                addr_space_id = addr_stack.pop()
-                addr_stack.append(self.machine.read_addr(addr, addr_space_id))
-            
-            elif opcode == DW_OP.xderef_size:
-                addr = addr_stack.pop()
-                addr_space_id = addr_stack.pop()
-                addr_stack.append(self.machine.read_addr(addr, addr_space_id))
-            
-            # Arithmetic and Logical Operations
-            elif opcode == DW_OP.abs:
-                top = addr_stack.pop()
-                addr_stack.append(abs(top))
-            
-            elif opcode == DW_OP.and_:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_top & former_second)
-            
-            elif opcode == DW_OP.div:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second // former_top)
-            
-            elif opcode == DW_OP.minus:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second - former_top)
-            
-            elif opcode == DW_OP.mod:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second % former_top)
-            
-            elif opcode == DW_OP.mul:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second * former_top)
-            
-            elif opcode == DW_OP.neg:
-                top = addr_stack.pop()
-                addr_stack.append(-top)
-            
-            elif opcode == DW_OP.not_:
-                top = addr_stack.pop()
-                addr_stack.append(~top)
-            
-            elif opcode == DW_OP.plus:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second + former_top)
-            
-            elif opcode == DW_OP.plus_uconst:
-                top = addr_stack.pop()
-                addr_stack.append(top + operand_1)
-            
-            elif opcode == DW_OP.shl:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second << former_top)
-            
-            elif opcode == DW_OP.shr:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second >> former_top)
-            
-            elif opcode == DW_OP.shra:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second >> former_top)
-            
-            elif opcode == DW_OP.xor:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                addr_stack.append(former_second ^ former_top)
-            
-            # Control Flow Operations
-            elif opcode >= DW_OP.eq and opcode <= DW_OP.ne:
-                former_top, former_second = Expression.__get_values(addr_stack)
-                if opcode == DW_OP.eq:
-                    control = former_top == former_second
-                elif opcode == DW_OP.ge:
-                    control = former_top >= former_second
-                elif opcode == DW_OP.gt:
-                    control = former_top > former_second
-                elif opcode == DW_OP.le:
-                    control = former_top <= former_second
-                elif opcode == DW_OP.lt:
-                    control = former_top < former_second
-                elif opcode == DW_OP.ne:
-                    control = former_top != former_second
-                addr_stack.append(1 if control else 0)
-            
-            elif opcode == DW_OP.skip:
-                i = self.addr_index_dict[op_addr + operand_1]
-                continue
-            
-            elif opcode == DW_OP.bra:
-                top = addr_stack.pop()
-                if top != 0:
-                    i = self.addr_index_dict[op_addr + operand_1]
-                    continue
-            
-            # Special Operations
-            elif opcode == DW_OP.piece:
-                self.size = operand_1
-            
-            i += 1
-        
-        return addr_stack.pop() 
+                handler, operand_1, operand_2 = op_breg, operand_2, operand_1
+            elif opcode in (DW_OP.skip, DW_OP.bra):
+                handler = op_skip if opcode == DW_OP.skip else op_bra
+                # The offset counts from the end of the 2 bytes operand
+                target = instruction.addr + 3 + operand_1
+                if target == len(self.code):
+                    operand_1 = len(self.instructions)
+                elif target in self.addr_index_dict:
+                    operand_1 = self.addr_index_dict[target]
+                else:
+                    raise ParseError("Branch out of the expression: %s" % instruction)
+            elif opcode in ADDRESS_SIZE_OPERATIONS:
+                handler = ADDRESS_SIZE_OPERATIONS[opcode]
+                operand_1 = self.dwarf.max_addr
+            else:
+                raise ParseError("Cannot evaluate %s" % instruction)
+            program.append((handler, operand_1, operand_2))
+        return program
+    
+    @lazy_property
+    def has_branches(self):
+        return any(handler in (op_skip, op_bra) for handler, _, _ in self.program)
+    
+    def evaluate(self, base_address=0, machine=None):
+        """
+        Run the expression on a stack holding *base_address*, as for the
+        data_member_location of a member, and return the top of the stack.
+        The registers and the memory are read through *machine*, see Machine.
+        A register location evaluates to the value of the register, and
+        the pieces of a composite location are not assembled: the result is
+        the location of the last piece.
+        """
+        if machine is None:
+            machine = NO_MACHINE
+        stack = [base_address]
+        program = self.program
+        if not self.has_branches:
+            for handler, operand_1, operand_2 in program:
+                handler(stack, operand_1, operand_2, machine)
+        else:
+            i = 0
+            end = len(program)
+            while i < end:
+                handler, operand_1, operand_2 = program[i]
+                target = handler(stack, operand_1, operand_2, machine)
+                i = i + 1 if target is None else target
+        return stack.pop()
     
     def __str__(self):
         return ' '.join(map(str, self.instructions))
 
 
 if __name__ == '__main__':
-    from dwarf.stream import DwarfList
+    from bintools.dwarf.stream import DwarfList
     location_data = [0x23, 0x08]
     test_stream = DwarfList(location_data)
     
-    e = Expression(test_stream, len(location_data))
+    e = test_stream.read_expression(test_stream.buf, 0, len(location_data))
     loc = e.evaluate()
     
     assert loc == 8, 'Error evaluating: %s' % location_data
     
+    class TestMachine(Machine):
+        def read_reg(self, reg):
+            return 0x1000 * reg
+        
+        def read_addr(self, addr, size=None, addr_space_id=None):
+            return addr + 1
+    
+    for location_data, expected in (
+            ([0x31, 0x35, 0x1a], 1),                    # lit1 lit5 and
+            ([0x3a, 0x33, 0x1c], 7),                    # lit10 lit3 minus
+            ([0x3a, 0x33, 0x2a], 1),                    # lit10 lit3 ge
+            ([0x3a, 0x33, 0x16, 0x2a], 0),              # lit10 lit3 swap ge
+            ([0x31, 0x32, 0x33, 0x17, 0x13, 0x13], 3),  # lit1 lit2 lit3 rot drop drop
+            ([0x30, 0x28, 0x01, 0x00, 0x31, 0x32], 2),  # lit0 bra(1) lit1 lit2
+            ([0x31, 0x28, 0x01, 0x00, 0x31, 0x32], 2),  # lit1 bra(1) lit1 lit2
+            ([0x2f, 0x01, 0x00, 0x38, 0x39], 9),        # skip(1) lit8 lit9
+            ([0x72, 0x08, 0x06], 0x2009),               # breg2(8) deref
+            ([0x92, 0x03, 0x7f], 0x2fff),               # bregx(3,-1)
+            ([0x11, 0x79, 0x33, 0x1b], -2),             # consts(-7) lit3 div
+            ([0x11, 0x79, 0x35, 0x1d], 4),              # consts(-7) lit5 mod
+            ([0x37, 0x11, 0x7e, 0x1d], 7),              # lit7 consts(-2) mod
+            ([0x11, 0x7f, 0x3c, 0x25], 0xfffff),        # consts(-1) lit12 shr
+            ([0x11, 0x7f, 0x34, 0x24], 0xfffffff0),     # consts(-1) lit4 shl
+            ([0x31, 0x08, 0x1f, 0x24], 0x80000000),     # lit1 const1u(31) shl
+            ([0x31, 0x08, 0x20, 0x24], 0)):             # lit1 const1u(32) shl
+        test_stream = DwarfList(location_data)
+        e = test_stream.read_expression(test_stream.buf, 0, len(location_data))
+        loc = e.evaluate(machine=TestMachine())
+        assert loc == expected, 'Error evaluating %s: %s' % (e, loc)
+    
+    # Without a machine, the registers and the memory cannot be read
+    for location_data in ([0x72, 0x08], [0x91, 0x08], [0x9c], [0x30, 0x06]):
+        test_stream = DwarfList(location_data)
+        e = test_stream.read_expression(test_stream.buf, 0, len(location_data))
+        try:
+            e.evaluate()
+        except ParseError:
+            pass
+        else:
+            assert False, 'Evaluated %s without a machine' % e
+    
     print('OK')
@@ -4,7 +4,7 @@ Written by Emilio Monti <emilmont@gmail.com>
 """
 from __future__ import print_function
 from sys import stderr
-from bintools.dwarf.stream import SectionLoader
+from bintools.dwarf.stream import SectionLoader, read_uleb128, read_sleb128, read_string
 from bintools.dwarf.enums import DW_CFA
 
 
@@ -49,12 +49,12 @@ DW_CFA_OPERANDS = {
 }
 
 
-def parse_call_frame_instructions(dwarf, length):
+def parse_call_frame_instructions(dwarf, buf, pos, stop):
     instructions = []
+    readers = dwarf.readers
     
-    stop = dwarf.io.tell() + length
-    while dwarf.io.tell() < stop:
-        opcode = dwarf.u08()
+    while pos < stop:
+        opcode, pos = dwarf.decoder.u08(buf, pos)
         if opcode == DW_CFA.nop:
             continue
         
@@ -65,13 +65,13 @@ def parse_call_frame_instructions(dwarf, length):
             operand_1 = opcode & 0x3F
             opcode = primary_opcode
             if primary_opcode == DW_CFA.offset:
-                operand_2 = dwarf.ULEB128()
+                operand_2, pos = read_uleb128(buf, pos)
         else:
             if opcode in DW_CFA_OPERANDS:
                 type_1, type_2 = DW_CFA_OPERANDS[opcode]
-                operand_1 = dwarf.read_type(type_1)
+                operand_1, pos = readers[type_1](buf, pos)
                 if type_2 is not None:
-                    operand_2 = dwarf.read_type(type_2)
+                    operand_2, pos = readers[type_2](buf, pos)
             else:
                 opname = DW_CFA[opcode] if opcode in DW_CFA else "unknown"
                 print("unhandled opcode: %02x (%s)" % (opcode,opname), file=stderr)
@@ -82,18 +82,16 @@ def parse_call_frame_instructions(dwarf, length):
 
 
 class CallFrameInformation(object):
-    def __init__(self, dwarf, offset, length):
+    def __init__(self, dwarf, buf, pos, offset, stop):
         self.offset = offset
-        start = dwarf.io.tell()
-        ver = dwarf.check_version(handled=[1, 3], bytes=1)
+        ver, pos = dwarf.check_version(buf, pos, handled=[1, 3], bytes=1)
         
-        self.augmentation = dwarf.read_string()
-        self.code_alignment_factor = dwarf.ULEB128()
-        self.data_alignment_factor = dwarf.SLEB128()
-        self.return_address_register = dwarf.u08()
+        self.augmentation, pos = read_string(buf, pos)
+        self.code_alignment_factor, pos = read_uleb128(buf, pos)
+        self.data_alignment_factor, pos = read_sleb128(buf, pos)
+        self.return_address_register, pos = dwarf.decoder.u08(buf, pos)
         
-        instr_length = length - (dwarf.io.tell() - start)
-        self.initial_instructions =  parse_call_frame_instructions(dwarf, instr_length)
+        self.initial_instructions =  parse_call_frame_instructions(dwarf, buf, pos, stop)
     
     def __str__(self):
         s = ['<%d> CFI:' % self.offset]
@@ -111,14 +109,12 @@ class FrameTable(object):
 
 
 class FrameDescriptionEntry(object):
-    def __init__(self, dwarf, offset, length, cie):
-        start = dwarf.io.tell()
+    def __init__(self, dwarf, buf, pos, offset, stop, cie):
         self.cie_p = cie
-        self.initial_location = dwarf.read_ref_addr()
-        self.address_range = dwarf.read_ref_addr()
+        self.initial_location, pos = dwarf.read_addr(buf, pos)
+        self.address_range, pos = dwarf.read_addr(buf, pos)
         
-        instr_length = length - (dwarf.io.tell() - start)
-        self.instructions =  parse_call_frame_instructions(dwarf, instr_length)
+        self.instructions =  parse_call_frame_instructions(dwarf, buf, pos, stop)
     
     def __str__(self):
         s = ['FDE:']
@@ -128,15 +124,14 @@ class FrameDescriptionEntry(object):
         return '\n   '.join(s)
 
 
-def debugFrameEntry(dwarf, offset):
-    length = dwarf.u32()
-    cie =  dwarf.u32()
-    # remaining length, without cie's bytes
-    length -= 4
+def debugFrameEntry(dwarf, buf, pos, offset):
+    length, pos = dwarf.decoder.u32(buf, pos)
+    stop = pos + length
+    cie, pos =  dwarf.decoder.u32(buf, pos)
     if cie == dwarf.CIE_ID:
-        return CallFrameInformation(dwarf, offset, length)
+        return CallFrameInformation(dwarf, buf, pos, offset, stop), stop
     else:
-        return FrameDescriptionEntry(dwarf, offset, length, cie)
+        return FrameDescriptionEntry(dwarf, buf, pos, offset, stop, cie), stop
 
 
 class FrameLoader(SectionLoader):
@@ -3,27 +3,63 @@ Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
 from os.path import join, dirname
+from array import array
+from bisect import bisect_left, bisect_right
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
 from bintools.dwarf.enums import DW_AT, DW_TAG, DW_LANG, DW_ATE, DW_FORM
+from bintools.dwarf.stream import read_uleb128
+from bintools.dwarf.abbrev import EXPRESSION_ATTRIBS
+from bintools.dwarf.cache import pack_array, unpack_array
+from bintools.utils import lazy_property
 
 
 class Attrib(object):
-    def __init__(self, cu, attrib_form):
+    """
+    Decoded attribute: the name and form are those of the shared AttribForm
+    of the abbreviation, stored as DW_AT and DW_FORM ints
+    """
+    __slots__ = ('cu', 'attrib_form', 'value')
+    
+    def __init__(self, cu, attrib_form, value=None):
         self.cu = cu
-        self.name = DW_AT[attrib_form.name_id]
-        self.form = DW_FORM[attrib_form.form]
-        if   self.name in ['location', 'data_member_location', 'frame_base'] and self.form[0:5] == 'block':
-            self.value = self.cu.dwarf.read_expr_block(attrib_form.form)
-        else:
-            self.value = self.cu.dwarf.read_form(attrib_form.form)
+        self.attrib_form = attrib_form
+        self.value = value
+    
+    @property
+    def name_id(self):
+        return self.attrib_form.name_id
+    
+    @property
+    def form_id(self):
+        return self.attrib_form.form
+    
+    @property
+    def name(self):
+        return self.attrib_form.name
+    
+    @property
+    def form(self):
+        return self.attrib_form.form_name
+    
+    def is_loc_list(self):
+        """
+        Whether the value is the offset of a location list in .debug_loc:
+        a sec_offset, or before DWARF 4 a data4 or data8, of a location
+        attribute. Other constants are plain values.
+        """
+        if self.name not in EXPRESSION_ATTRIBS or self.cu.dwarf.loc is None:
+            return False
+        form = self.form
+        return form == 'sec_offset' or (form in ('data4', 'data8') and self.cu.version < 4)
     
     def get_value(self):
         if   self.name == 'ranges':
             value = self.cu.dwarf.ranges.get(self.value)
-        elif self.name in ['location', 'data_member_location', 'frame_base'] and type(self.value) == int:
-            if self.cu.dwarf.loc is None:
-                value = self.value	# should be a constant value
-            else:
-                value = self.cu.dwarf.loc.get_loc_list(self.value)
+        elif self.is_loc_list():
+            value = self.cu.dwarf.loc.get_loc_list(self.value)
         else:
             value = self.value
         return value
@@ -39,12 +75,9 @@ class Attrib(object):
             value = '\n' + str(self.cu.dwarf.ranges.get(self.value))
         elif self.name in ['low_pc', 'high_pc']:
             value = '0x%08x' % self.value
-        elif self.name in ['location', 'data_member_location', 'frame_base'] and type(self.value) == int:
-            if self.cu.dwarf.loc is None:
-                value = self.value	# should be a constant value
-            else:
-                loc_list = self.cu.dwarf.loc.get_loc_list(self.value)
-                value = '\n    ' + '\n    '.join(map(str, loc_list))
+        elif self.is_loc_list():
+            loc_list = self.cu.dwarf.loc.get_loc_list(self.value)
+            value = '\n    ' + '\n    '.join(map(str, loc_list))
         else:
             value = self.value
         return value
@@ -53,30 +86,112 @@ class Attrib(object):
         return '%s/%s: %s' % (self.name, self.form, self.get_str())
 
 
+def get_pc_ranges(attr_dict, base_address=0):
+    """
+    Return the (low, high) address ranges of a DIE with the attributes
+    *attr_dict*, from its low_pc/high_pc or ranges attributes; the ranges
+    lists are relative to the *base_address* of the CU
+    """
+    if 'low_pc' in attr_dict and 'high_pc' in attr_dict:
+        low = attr_dict['low_pc'].value
+        high = attr_dict['high_pc']
+        if high.form == 'addr':
+            return [(low, high.value)]
+        return [(low, low + high.value)] # DWARF 4: offset from low_pc
+    if 'ranges' in attr_dict:
+        return attr_dict['ranges'].get_value().get_pc_ranges(base_address)
+    return []
+
+
 class DIE(object):
-    def __init__(self, dwarf, cu, abbrev_dict, level):
-        self.cu = cu
-        self.offset = dwarf.io.tell() - cu.offset
-        self.attr_index = dwarf.ULEB128()
-        self.tag = None
-        self.attr = []
-        self.attr_dict = {}
-        
-        self.level = level
-        
-        if self.attr_index == 0:
-            return
-        
-        abbr = abbrev_dict[self.attr_index]
-        self.tag = abbr.tag
-        
-        for attrib_form in abbr.attrib_forms:
-            a = Attrib(cu, attrib_form)
-            self.attr.append(a)
-            self.attr_dict[a.name] = a
-        
-        self.has_children = abbr.has_children
-        self.children = []
+    """
+    Lightweight view of the DIE number *index* of the DIETree *tree*: the
+    tree layout is kept in the tree arrays and the attributes are decoded on
+    access.
+    """
+    __slots__ = ('tree', 'index', '_attr', '_attr_dict')
+    
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+        self._attr = None
+        self._attr_dict = None
+    
+    @property
+    def cu(self):
+        return self.tree.cu
+    
+    @property
+    def offset(self):
+        return self.tree.die_offsets[self.index]
+    
+    @property
+    def level(self):
+        return self.tree.die_levels[self.index]
+    
+    @property
+    def abbrev(self):
+        return self.cu.abbrevs[self.tree.die_abbrevs[self.index]]
+    
+    @property
+    def attr_index(self):
+        return self.tree.die_abbrevs[self.index]
+    
+    @property
+    def tag(self):
+        return self.abbrev.tag
+    
+    @property
+    def has_children(self):
+        return self.abbrev.has_children
+    
+    @property
+    def attr(self):
+        if self._attr is None:
+            cu = self.cu
+            self._attr = cu.read_attribs(self.abbrev, cu._pos + self.tree.die_attr_pos[self.index])
+        return self._attr
+    
+    @property
+    def attr_dict(self):
+        if self._attr_dict is None:
+            self._attr_dict = dict(zip(self.abbrev.attr_names, self.attr))
+        return self._attr_dict
+    
+    @property
+    def parent(self):
+        i = self.tree.die_parents[self.index]
+        if i < 0:
+            return None
+        return DIE(self.tree, i)
+    
+    @property
+    def children(self):
+        tree = self.tree
+        children = []
+        i = self.index + 1
+        if i < len(tree.die_parents) and tree.die_parents[i] == self.index:
+            while i >= 0:
+                children.append(DIE(tree, i))
+                i = tree.die_siblings[i]
+        return children
+    
+    def get_pc_ranges(self):
+        """
+        Return the (low, high) address ranges covered by this DIE
+        """
+        return get_pc_ranges(self.attr_dict, self.cu.base_address)
+    
+    def __eq__(self, other):
+        # The same DIE, in the full tree or in a pruned one
+        return (isinstance(other, DIE) and self.cu is other.cu and
+                self.offset == other.offset)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash((id(self.cu), self.offset))
     
     def short_description(self):
         description = '<%d> %s ' % (self.offset, DW_TAG[self.tag])
@@ -92,65 +207,377 @@ class DIE(object):
         return '\n'.join(map(str, [tag] + self.attr))
 
 
+class DIEList(Sequence):
+    """
+    The DIEs of *tree* in .debug_info order
+    """
+    def __init__(self, tree):
+        self.tree = tree
+    
+    def __len__(self):
+        return len(self.tree.die_offsets)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [DIE(self.tree, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return DIE(self.tree, i)
+
+
+class DIEDict(Mapping):
+    """
+    The DIEs of *tree* by offset
+    """
+    def __init__(self, tree):
+        self.tree = tree
+    
+    def __len__(self):
+        return len(self.tree.die_offsets)
+    
+    def __iter__(self):
+        return iter(self.tree.die_offsets)
+    
+    def __getitem__(self, offset):
+        if offset is None: # a missing reference, as with a dict
+            raise KeyError(offset)
+        offsets = self.tree.die_offsets
+        i = bisect_left(offsets, offset)
+        if i == len(offsets) or offsets[i] != offset:
+            raise KeyError(offset)
+        return DIE(self.tree, i)
+
+
+class DIETree(object):
+    def __init__(self, cu, partial=False):
+        """
+        Layout of the DIE tree of *cu*, in arrays indexed by DIE number:
+        die_offsets (from the CU start), die_abbrevs (abbreviation codes),
+        die_levels, die_parents and die_siblings (DIE numbers, -1 for none)
+        and die_attr_pos (position of the attribute values, from the CU start).
+        A *partial* tree lacks the subtrees pruned by CU.parse_dies.
+        """
+        self.cu = cu
+        self.partial = partial
+        self.die_abbrevs = array('I')
+        self.die_levels = array('H')
+        self.die_parents = array('i')
+        self.die_siblings = array('i')
+        self.die_attr_pos = array('I')
+        self.die_offsets = array('I')
+    
+    def get_arrays(self):
+        return (self.die_abbrevs, self.die_levels, self.die_parents,
+                self.die_siblings, self.die_attr_pos, self.die_offsets)
+    
+    def set_arrays(self, arrays):
+        (self.die_abbrevs, self.die_levels, self.die_parents,
+         self.die_siblings, self.die_attr_pos, self.die_offsets) = arrays
+    
+    @property
+    def dies(self):
+        return DIEList(self)
+    
+    @property
+    def dies_dict(self):
+        return DIEDict(self)
+    
+    @property
+    def root(self):
+        return DIE(self, 0)
+    
+    def get_die_by_offset(self, offset):
+        return self.dies_dict[offset]
+
+
 class CU(object):
-    def __init__(self, dwarf, overall_offset):
+    def __init__(self, dwarf, buf, pos, overall_offset, header=None):
+        """
+        Only the CU header and the root DIE's attributes are decoded here, the
+        DIE tree is parsed on first access of dies, dies_dict, root or
+        compile_unit. A *header* from get_header skips the decoding.
+        The CU starts at position *pos* of *buf*, which depends on the I/O
+        mode (see ELF.get_section_buffer); offset is its file offset.
+        """
         self.dwarf = dwarf
+        self.buf = buf
         self.overall_offset = overall_offset
-        self.offset = dwarf.io.tell()
+        self.offset = dwarf.sect_dict['.debug_info'].offset + overall_offset
+        self._pos = pos
         
-        length = dwarf.u32()
-        stop = dwarf.io.tell() + length
+        self.line_offset = 0
         
-        ver = dwarf.check_version(handled=[2, 3, 4])
+        self.tree = None
+        self.function_starts = None
         
-        abbrev_offset = dwarf.u32()
-        self.pointer_size = dwarf.u08()
+        if header is not None:
+            (stop, self.version, self.abbrev_offset, self.pointer_size,
+             dies_start, self.stmt_list, self.name, self.comp_dir,
+             self.pc_ranges) = header
+            self.stop = pos + stop
+            self.dies_start = pos + dies_start
+            return
         
-        abbrevs = dwarf.abbrev.get(abbrev_offset)
-        self.line_offset = 0
+        length, pos = dwarf.decoder.u32(buf, pos)
+        self.stop = pos + length
         
-        dwarf.io.seek(self.offset+11)
-        self.dies = []
-        self.dies_dict = {}
-        self.root = None
-        level = 0
-        die_stack = []
-        current_parent = None
-        while dwarf.io.tell() < stop:
-            die = DIE(dwarf, self, abbrevs, level)
-            if die.tag is None:
-                level -= 1
-                current_parent = die_stack.pop()
-            else:
-                # Add item to die list and dictionary
-                self.dies.append(die)
-                self.dies_dict[die.offset] = die
-                
-                # Set Root
-                if level == 0:
-                    if self.root == None:
-                        self.root = die
-                    else:
-                        raise Exception("I was expecting only one root for Compile Unit")
-                
-                if current_parent != None:
-                    current_parent.children.append(die)
-                
-                if die.has_children:
-                    level += 1
-                    die_stack.append(current_parent)
-                    current_parent = die
-        
-        self.compile_unit = self.dies[0]
-        self.stmt_list = self.compile_unit.attr_dict['stmt_list'].value
-        if 'comd_dir' in self.compile_unit.attr_dict:
-            self.comp_dir = self.compile_unit.attr_dict['comp_dir'].value
-            self.name = self.compile_unit.attr_dict['name'].value
+        self.version, pos = dwarf.check_version(buf, pos, handled=[2, 3, 4])
+        
+        self.abbrev_offset, pos = dwarf.decoder.u32(buf, pos)
+        self.pointer_size, pos = dwarf.decoder.u08(buf, pos)
+        self.dies_start = pos
+        
+        root_attr = self.read_root_attribs()
+        self.stmt_list = root_attr['stmt_list'].value
+        self.pc_ranges = get_pc_ranges(root_attr, self.base_address)
+        if 'comd_dir' in root_attr:
+            self.comp_dir = root_attr['comp_dir'].value
+            self.name = root_attr['name'].value
         else:
             # Assume that self.name contains a full path name
-            self.name = self.compile_unit.attr_dict['name'].value
+            self.name = root_attr['name'].value
             self.comp_dir = dirname(self.name)
     
+    def get_header(self):
+        """
+        Position independent CU header, for the index cache
+        """
+        return (self.stop - self._pos, self.version, self.abbrev_offset,
+                self.pointer_size, self.dies_start - self._pos,
+                self.stmt_list, self.name, self.comp_dir, self.pc_ranges)
+    
+    def read_root_attribs(self):
+        """
+        Decode the attributes of the root DIE, without parsing the DIE tree
+        """
+        attr_index, pos = read_uleb128(self.buf, self.dies_start)
+        abbr = self.abbrevs[attr_index]
+        return dict(zip(abbr.attr_names, self.read_attribs(abbr, pos)))
+    
+    @lazy_property
+    def base_address(self):
+        """
+        The low_pc of the root DIE (or 0): the location lists of the CU are
+        relative to it
+        """
+        root_attr = self.read_root_attribs()
+        if 'low_pc' in root_attr:
+            return root_attr['low_pc'].value
+        return 0
+    
+    @lazy_property
+    def abbrevs(self):
+        return self.dwarf.abbrev.get(self.abbrev_offset)
+    
+    def read_attribs(self, abbr, pos):
+        """
+        Decode the attributes of a DIE with abbreviation *abbr*, starting at
+        *pos*
+        """
+        buf = self.buf
+        attr = []
+        for attrib_form, reader in zip(abbr.attrib_forms, abbr.readers):
+            value, pos = reader(buf, pos)
+            attr.append(Attrib(self, attrib_form, value))
+        return attr
+    
+    def parse_dies(self, prune=None):
+        """
+        Walk the DIE tree and return its DIETree.
+        *prune* selects the DIEs whose children are not parsed: a collection
+        of tags, or a predicate on the DIE. The root DIE is never pruned.
+        Pruned subtrees are jumped over using DW_AT_sibling when available.
+        A pruned tree is partial: it is only returned, and its DIEs only see
+        each other; the full tree is the one of dies, dies_dict and root.
+        When the full tree is available, or with the index cache, the full
+        tree is returned whatever the pruning.
+        """
+        if self.tree is not None:
+            return self.tree
+        cache = self.dwarf.cache
+        if cache is not None:
+            prune = None
+            arrays = cache.get('tree-%d' % self.overall_offset)
+            if arrays is not None:
+                self.tree = DIETree(self)
+                self.tree.set_arrays(tuple(map(unpack_array, arrays)))
+                return self.tree
+        
+        buf = self.buf
+        abbrevs = self.abbrevs
+        prune_tags = frozenset()
+        if prune is not None and not callable(prune):
+            prune_tags = frozenset(prune)
+            prune = None
+        
+        tree = DIETree(self, partial=bool(prune_tags) or prune is not None)
+        (codes, levels, parents, siblings, attr_pos, offsets) = tree.get_arrays()
+        
+        level = 0
+        die_stack = []
+        parent = -1
+        previous = -1
+        pos = self.dies_start
+        while pos < self.stop:
+            offset = pos - self._pos
+            attr_index, pos = read_uleb128(buf, pos)
+            if attr_index == 0:
+                level -= 1
+                parent, previous = die_stack.pop()
+                continue
+            
+            i = len(offsets)
+            if level == 0 and i != 0:
+                raise Exception("I was expecting only one root for Compile Unit")
+            
+            offsets.append(offset)
+            codes.append(attr_index)
+            levels.append(level)
+            parents.append(parent)
+            siblings.append(-1)
+            attr_pos.append(pos - self._pos)
+            if previous >= 0:
+                siblings[previous] = i
+            previous = i
+            
+            abbr = abbrevs[attr_index]
+            if abbr.has_children and level > 0 and (abbr.tag in prune_tags or
+                    (prune is not None and prune(DIE(tree, i)))):
+                if abbr.sibling is not None:
+                    sibling_pos, read_sibling = abbr.sibling
+                    pos = self._pos + read_sibling(buf, pos + sibling_pos)[0]
+                else:
+                    pos = self.skip_subtree(abbr, pos)
+                continue
+            
+            for size, skip in abbr.skippers:
+                pos = skip(buf, pos + size)
+            pos += abbr.size
+            
+            if abbr.has_children:
+                level += 1
+                die_stack.append((parent, previous))
+                parent = i
+                previous = -1
+        
+        if tree.partial:
+            return tree
+        self.tree = tree
+        if cache is not None:
+            cache.put('tree-%d' % self.overall_offset,
+                      tuple(map(pack_array, tree.get_arrays())))
+        return tree
+    
+    def skip_subtree(self, abbr, pos):
+        """
+        Skip the attributes (at *pos*) and the children of a DIE with
+        abbreviation *abbr*, return the position of its sibling
+        """
+        buf = self.buf
+        abbrevs = self.abbrevs
+        depth = 0
+        while True:
+            for size, skip in abbr.skippers:
+                pos = skip(buf, pos + size)
+            pos += abbr.size
+            if abbr.has_children:
+                depth += 1
+            
+            while True:
+                if depth == 0:
+                    return pos
+                attr_index, pos = read_uleb128(buf, pos)
+                if attr_index != 0:
+                    break
+                depth -= 1
+            abbr = abbrevs[attr_index]
+    
+    # DIE tree properties ############################################
+    @property
+    def dies(self):
+        return self.parse_dies().dies
+    
+    @property
+    def dies_dict(self):
+        return self.parse_dies().dies_dict
+    
+    @property
+    def root(self):
+        return self.parse_dies().root
+    
+    @property
+    def compile_unit(self):
+        return self.root
+    
+    def top_level_dies(self):
+        """
+        Return the children of the root DIE. If the full DIE tree is not
+        parsed yet, only its top level is, in a partial DIETree.
+        """
+        return self.parse_dies(prune=lambda die: True).root.children
+    
+    # Function index #################################################
+    def build_function_index(self):
+        """
+        Index the code ranges of the top level functions, sorted by start:
+        function_starts, function_ranges as (low, high, name) and
+        function_max_ends, the maximum high up to each range.
+        """
+        ranges = []
+        for die in self.top_level_dies():
+            if die.tag != DW_TAG.subprogram:
+                continue
+            pc_ranges = die.get_pc_ranges()
+            if not pc_ranges:
+                continue
+            name = self.get_function_name(die)
+            for low, high in pc_ranges:
+                if low < high:
+                    ranges.append((low, high, name))
+        ranges.sort()
+        
+        self.function_ranges = ranges
+        self.function_starts = [r[0] for r in ranges]
+        self.function_max_ends = []
+        max_end = 0
+        for low, high, name in ranges:
+            max_end = max(max_end, high)
+            self.function_max_ends.append(max_end)
+    
+    def get_function_name(self, die):
+        # Concrete out-of-line instances and definitions of declarations
+        # take the name of the DIE they refer to
+        attr_dict = die.attr_dict
+        for ref in ('abstract_origin', 'specification'):
+            if 'name' in attr_dict or ref not in attr_dict:
+                continue
+            try:
+                attr_dict = die.tree.dies_dict[attr_dict[ref].value].attr_dict
+            except KeyError:
+                return None
+        if 'name' in attr_dict:
+            return attr_dict['name'].value
+        return None
+    
+    def get_function_by_addr(self, addr):
+        """
+        Return the name of the top level function whose code contains
+        *addr*, or None
+        """
+        if self.function_starts is None:
+            self.build_function_index()
+        
+        i = bisect_right(self.function_starts, addr) - 1
+        # Ranges can nest or overlap: look back until none can contain addr
+        while i >= 0 and addr < self.function_max_ends[i]:
+            low, high, name = self.function_ranges[i]
+            if addr < high:
+                return name
+            i -= 1
+        return None
+    
     def get_file_path(self, i):
         dir, name = self.dwarf.stmt.get(self).get_file_path(i)
         if dir is None:
@@ -171,21 +598,41 @@ class CU(object):
 
 class DebugInfoLoader(object):
     def __init__(self, dwarf):
+        """
+        Index the CUs of .debug_info by offset and file name, reading only
+        their headers (or the cached ones); see CU.
+        """
         debug_info = dwarf.sect_dict['.debug_info']
-        dwarf.io.seek(debug_info.offset)
+        buf, start = dwarf.get_section_buffer(debug_info)
         
-        overall_offset = 0
         self.cus = []
         self.cus_dict = {}
         self.cus_files = {}
+        headers = None
+        if dwarf.cache is not None:
+            headers = dwarf.cache.get('cus')
+        
+        if headers is not None:
+            for overall_offset, header in headers:
+                self.add_cu(CU(dwarf, buf, start + overall_offset, overall_offset, header))
+            return
+        
+        overall_offset = 0
         while True:
-            cu = CU(dwarf, overall_offset)
-            self.cus.append(cu)
-            self.cus_dict[overall_offset] = cu
-            self.cus_files[cu.name] = cu
-            overall_offset = dwarf.io.tell() - debug_info.offset
+            cu = CU(dwarf, buf, start + overall_offset, overall_offset)
+            self.add_cu(cu)
+            overall_offset = cu.stop - start
             if overall_offset >= debug_info.size:
                 break
+        
+        if dwarf.cache is not None:
+            dwarf.cache.put('cus', [(cu.overall_offset, cu.get_header())
+                                    for cu in self.cus])
+    
+    def add_cu(self, cu):
+        self.cus.append(cu)
+        self.cus_dict[cu.overall_offset] = cu
+        self.cus_files[cu.name] = cu
     
     def get_cu_by_offset(self, offset):
         return self.cus_dict[offset]
@@ -195,3 +642,60 @@ class DebugInfoLoader(object):
     
     def __str__(self):
         return '\n'.join(['.debug_info'] + list(map(str, self.cus)))
+
+
+class TypeNameIndex(object):
+    # Tags of the named types worth indexing
+    TAGS = frozenset([DW_TAG.structure_type, DW_TAG.union_type,
+                      DW_TAG.enumeration_type, DW_TAG.typedef, DW_TAG.base_type])
+    
+    def __init__(self, dwarf):
+        """
+        Index the named types defined at the top level of every CU, as
+        name -> (CU offset, DIE offset); the first definition of a name wins
+        and declarations are not indexed.
+        The index is read from .debug_pubtypes when available, otherwise
+        built scanning the top level DIEs of all the CUs.
+        """
+        self.dwarf = dwarf
+        self.types = None
+        if dwarf.cache is not None:
+            self.types = dwarf.cache.get('types')
+        
+        if self.types is None:
+            if dwarf.pubtypes is not None:
+                self.types = self.read_pubtypes(dwarf.pubtypes)
+            else:
+                self.types = self.scan_cus(dwarf.info.cus)
+            if dwarf.cache is not None:
+                dwarf.cache.put('types', self.types)
+    
+    def read_pubtypes(self, pubtypes):
+        types = {}
+        for entry in pubtypes.entries:
+            for name, pubname in entry.names.items():
+                types.setdefault(name, (entry.info_offset, pubname.offset))
+        return types
+    
+    def scan_cus(self, cus):
+        types = {}
+        for cu in cus:
+            for die in cu.top_level_dies():
+                if die.tag not in self.TAGS:
+                    continue
+                attr_dict = die.attr_dict
+                if 'name' not in attr_dict or 'declaration' in attr_dict:
+                    continue
+                types.setdefault(attr_dict['name'].value, (cu.overall_offset, die.offset))
+        return types
+    
+    def __contains__(self, name):
+        return name in self.types
+    
+    def get_die(self, name):
+        """
+        Return the DIE defining the type *name*
+        """
+        cu_offset, die_offset = self.types[name]
+        cu = self.dwarf.info.get_cu_by_offset(cu_offset)
+        return cu.get_die_by_offset(die_offset)
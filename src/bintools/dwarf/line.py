@@ -2,161 +2,380 @@
 Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
-from copy import copy
+from array import array
+from os.path import basename, join
+from bisect import bisect_left, bisect_right
 from bintools.dwarf.enums import DW_LNS, DW_LNE
-from bintools.dwarf.stream import SectionCache
+from bintools.dwarf.stream import (SectionCache, read_uleb128, read_sleb128,
+                                   read_string, skip_leb128)
+from bintools.dwarf.cache import pack_array, unpack_array
+
+
+# 'L' is only 32 bits wide on some platforms, and Python 2 has no 'Q'
+ADDRESS_TYPECODE = 'L' if array('L').itemsize >= 8 else 'Q'
+
+# Flag bits of the line matrix rows
+IS_STMT = 1
+BASIC_BLOCK = 2
+END_SEQUENCE = 4
 
 
 class MachineRegisters(object):
-    default_is_stmt = False
+    __slots__ = ('address', 'op_index', 'file', 'line', 'column',
+                 'is_stmt', 'basic_block', 'end_sequence', 'default_is_stmt')
     
-    def __init__(self):
+    def __init__(self, default_is_stmt=False):
+        self.default_is_stmt = default_is_stmt
         self.reset()
     
     def reset(self):
         self.address = 0
+        self.op_index = 0
         self.file = 1
         self.line = 1
         self.column = 0
-        self.is_stmt = MachineRegisters.default_is_stmt
+        self.is_stmt = self.default_is_stmt
         self.basic_block = False
         self.end_sequence = False
 
 
-def statement_information(dwarf, prog):
-    MachineRegisters.default_is_stmt = prog.default_is_stmt
-    regs = MachineRegisters()
-    matrix = []
+class LineRow(object):
+    """
+    A row of the line number matrix, with the MachineRegisters attributes
+    """
+    __slots__ = ('address', 'file', 'line', 'column',
+                 'is_stmt', 'basic_block', 'end_sequence')
+    
+    def __init__(self, address, file, line, column, flags):
+        self.address = address
+        self.file = file
+        self.line = line
+        self.column = column
+        self.is_stmt = (flags & IS_STMT) != 0
+        self.basic_block = (flags & BASIC_BLOCK) != 0
+        self.end_sequence = (flags & END_SEQUENCE) != 0
+
+
+class LineMatrix(object):
+    def __init__(self):
+        """
+        Line number matrix stored by columns: addresses, files, lines,
+        columns and flags (IS_STMT, BASIC_BLOCK, END_SEQUENCE bits).
+        Indexing and iteration produce LineRow objects on demand.
+        """
+        self.addresses = array(ADDRESS_TYPECODE)
+        self.files = array('I')
+        self.lines = array('i')
+        self.columns = array('I')
+        self.flags = array('B')
+    
+    def append(self, regs):
+        self.addresses.append(regs.address)
+        self.files.append(regs.file)
+        self.lines.append(regs.line)
+        self.columns.append(regs.column)
+        self.flags.append((regs.is_stmt and IS_STMT) |
+                          (regs.basic_block and BASIC_BLOCK) |
+                          (regs.end_sequence and END_SEQUENCE))
+    
+    def __len__(self):
+        return len(self.addresses)
+    
+    def __getitem__(self, i):
+        return LineRow(int(self.addresses[i]), self.files[i], self.lines[i],
+                       self.columns[i], self.flags[i])
+    
+    def __iter__(self):
+        for i in range(len(self.addresses)):
+            yield self[i]
+    
+    # Compact pickling, for the index cache
+    def __getstate__(self):
+        return tuple(map(pack_array, (self.addresses, self.files, self.lines,
+                                      self.columns, self.flags)))
+    
+    def __setstate__(self, state):
+        (self.addresses, self.files, self.lines,
+         self.columns, self.flags) = map(unpack_array, state)
+
+
+# Standard opcodes: handler(dwarf, prog, regs, matrix, buf, pos) -> pos
+def lns_copy(dwarf, prog, regs, matrix, buf, pos):
+    matrix.append(regs)
+    regs.basic_block = False
+    return pos
+
+def lns_advance_pc(dwarf, prog, regs, matrix, buf, pos):
+    operation_advance, pos = read_uleb128(buf, pos)
+    prog.advance(regs, operation_advance)
+    return pos
+
+def lns_advance_line(dwarf, prog, regs, matrix, buf, pos):
+    line_advance, pos = read_sleb128(buf, pos)
+    regs.line += line_advance
+    return pos
+
+def lns_set_file(dwarf, prog, regs, matrix, buf, pos):
+    regs.file, pos = read_uleb128(buf, pos)
+    return pos
+
+def lns_set_column(dwarf, prog, regs, matrix, buf, pos):
+    regs.column, pos = read_uleb128(buf, pos)
+    return pos
+
+def lns_negate_stmt(dwarf, prog, regs, matrix, buf, pos):
+    regs.is_stmt = not regs.is_stmt
+    return pos
+
+def lns_set_basic_block(dwarf, prog, regs, matrix, buf, pos):
+    regs.basic_block = True
+    return pos
+
+def lns_const_add_pc(dwarf, prog, regs, matrix, buf, pos):
+    prog.advance(regs, (255 - prog.opcode_base) // prog.line_range)
+    return pos
+
+def lns_fixed_advance_pc(dwarf, prog, regs, matrix, buf, pos):
+    address_advance, pos = dwarf.decoder.u16(buf, pos)
+    regs.address += address_advance
+    regs.op_index = 0
+    return pos
+
+STANDARD_OPCODES = {
+    DW_LNS.copy: lns_copy,
+    DW_LNS.advance_pc: lns_advance_pc,
+    DW_LNS.advance_line: lns_advance_line,
+    DW_LNS.set_file: lns_set_file,
+    DW_LNS.set_column: lns_set_column,
+    DW_LNS.negate_stmt: lns_negate_stmt,
+    DW_LNS.set_basic_block: lns_set_basic_block,
+    DW_LNS.const_add_pc: lns_const_add_pc,
+    DW_LNS.fixed_advance_pc: lns_fixed_advance_pc,
+}
+
+
+# Extended opcodes: handler(dwarf, prog, regs, matrix, buf, pos) -> pos
+def lne_end_sequence(dwarf, prog, regs, matrix, buf, pos):
+    regs.end_sequence = True
+    matrix.append(regs)
+    regs.reset()
+    return pos
+
+def lne_set_address(dwarf, prog, regs, matrix, buf, pos):
+    regs.address, pos = dwarf.read_addr(buf, pos)
+    regs.op_index = 0
+    return pos
+
+def lne_define_file(dwarf, prog, regs, matrix, buf, pos):
+    f, pos = read_file_entry(buf, pos)
+    prog.file_names.append(f)
+    return pos
+
+EXTENDED_OPCODES = {
+    DW_LNE.end_sequence: lne_end_sequence,
+    DW_LNE.set_address: lne_set_address,
+    DW_LNE.define_file: lne_define_file,
+    # DW_LNE.set_discriminator is skipped: the matrix has no such column
+}
+
+
+def statement_information(dwarf, buf, prog):
+    """
+    Run the line number program of *prog*, return its LineMatrix.
+    Special opcodes, the most frequent, are decoded inline through the
+    prog.special_opcodes table, the others through the standard and
+    extended opcode handler tables.
+    """
+    regs = MachineRegisters(prog.default_is_stmt)
+    matrix = LineMatrix()
+    add_address = matrix.addresses.append
+    add_file = matrix.files.append
+    add_line = matrix.lines.append
+    add_column = matrix.columns.append
+    add_flags = matrix.flags.append
+    
+    # The standard opcodes without handler are skipped, with their operands
+    handlers = [STANDARD_OPCODES.get(opcode) for opcode in range(prog.opcode_base)]
+    special_opcodes = prog.special_opcodes
+    single_op = prog.maximum_operations_per_instruction == 1
     
-    while dwarf.io.tell() < prog.stop:
-        opcode = dwarf.u08()
+    # The opcodes are read from a bytearray, the operands from the same bytes
+    code = bytes(buf[prog.program_start:prog.stop])
+    opcodes = bytearray(code)
+    pos = 0
+    stop = len(code)
+    while pos < stop:
+        opcode = opcodes[pos]
+        pos += 1
         
         # Special Opcodes
-        if opcode >= prog.opcode_base:
-            adj_opcode = opcode - prog.opcode_base
-            address_advance = adj_opcode/prog.line_range
-            line_advance = prog.line_base + (adj_opcode % prog.line_range)
-            
+        special = special_opcodes[opcode]
+        if special is not None:
+            address_advance, line_advance = special
             regs.line += line_advance
-            regs.address += (prog.min_instr_length * address_advance)
-            matrix.append(copy(regs))
+            if single_op:
+                regs.address += address_advance
+            else:
+                prog.advance(regs, address_advance)
+            add_address(regs.address)
+            add_file(regs.file)
+            add_line(regs.line)
+            add_column(regs.column)
+            add_flags((regs.is_stmt and IS_STMT) | (regs.basic_block and BASIC_BLOCK))
             regs.basic_block = False
         
         # Extended Opcodes
         elif opcode == 0:
-            dwarf.ULEB128() # length
-            extended_op = dwarf.u08()
-            if extended_op == DW_LNE.end_sequence:
-                regs.end_sequence = True
-                matrix.append(copy(regs))
-                regs.reset()
-            
-            elif extended_op == DW_LNE.set_address:
-                regs.address = dwarf.read_addr()
-            
-            elif extended_op == DW_LNE.define_file:
-                prog.file_names.append(FileEntry(dwarf))
-            
-            elif extended_op == DW_LNE.set_discriminator:
-                dwarf.ULEB128() # TODO?
-            
-            else:
-                assert False, 'Extended Opcode not implemented: %d' % extended_op
-            
-        # Standard Opcodes
-        elif opcode == DW_LNS.copy:
-            matrix.append(copy(regs))
-            regs.basic_block = False
-        
-        elif opcode == DW_LNS.advance_pc:
-            address_advance = dwarf.ULEB128()
-            regs.address += (prog.min_instr_length * address_advance)
-        
-        elif opcode == DW_LNS.advance_line:
-            regs.line += dwarf.SLEB128()
-        
-        elif opcode == DW_LNS.set_file:
-            regs.file = dwarf.ULEB128()
-        
-        elif opcode == DW_LNS.set_column:
-            regs.column = dwarf.ULEB128()
-        
-        elif opcode == DW_LNS.negate_stmt:
-            regs.is_stmt = not regs.is_stmt
-        
-        elif opcode == DW_LNS.set_basic_block:
-            regs.basic_block = True
-        
-        elif opcode == DW_LNS.const_add_pc:
-            regs.address += prog.min_instr_length * (
-                        (255 - prog.opcode_base) / prog.line_range)
+            length, pos = read_uleb128(code, pos)
+            handler = EXTENDED_OPCODES.get(opcodes[pos])
+            if handler is not None:
+                handler(dwarf, prog, regs, matrix, code, pos + 1)
+            pos += length
         
+        # Standard Opcodes
         else:
-            assert False, 'Opcode not implemented: %d' % opcode
+            handler = handlers[opcode]
+            if handler is not None:
+                pos = handler(dwarf, prog, regs, matrix, code, pos)
+            else:
+                for _ in range(prog.standard_opcode_lengths[opcode - 1]):
+                    pos = skip_leb128(code, pos)
     
     return matrix
 
 
 class FileEntry(object):
-    def __init__(self, dwarf):
-        self.name = dwarf.read_string()
-        if self.name == '':
-            return
-        
-        self.directory_index = dwarf.ULEB128()
-        self.time_last_mod = dwarf.ULEB128()
-        self.length = dwarf.ULEB128()
+    def __init__(self, name, directory_index, time_last_mod, length):
+        self.name = name
+        self.directory_index = directory_index
+        self.time_last_mod = time_last_mod
+        self.length = length
+
+
+def read_file_entry(buf, pos):
+    """
+    Return (FileEntry, new_pos), or (None, new_pos) at the end of the list
+    """
+    name, pos = read_string(buf, pos)
+    if name == '':
+        return None, pos
+    
+    directory_index, pos = read_uleb128(buf, pos)
+    time_last_mod, pos = read_uleb128(buf, pos)
+    length, pos = read_uleb128(buf, pos)
+    return FileEntry(name, directory_index, time_last_mod, length), pos
 
 
 class ProgramPrologue(object):
-    def __init__(self, dwarf):
-        total_length = dwarf.u32()
-        self.stop = dwarf.io.tell() + total_length
-        ver = dwarf.check_version(handled=[2, 3])
-        dwarf.u32() # prologue_length
+    def __init__(self, dwarf, buf, pos):
+        u08 = dwarf.decoder.u08
+        total_length, pos = dwarf.decoder.u32(buf, pos)
+        self.stop = pos + total_length
+        self.version, pos = dwarf.check_version(buf, pos, handled=[2, 3, 4])
+        prologue_length, pos = dwarf.decoder.u32(buf, pos)
+        self.program_start = pos + prologue_length
         
-        self.min_instr_length = dwarf.u08()
-        self.default_is_stmt = dwarf.u08() != 0
-        self.line_base = dwarf.s08()
-        self.line_range = dwarf.u08()
-        self.opcode_base = dwarf.u08()
+        self.min_instr_length, pos = u08(buf, pos)
+        self.maximum_operations_per_instruction = 1
+        if self.version >= 4:
+            self.maximum_operations_per_instruction, pos = u08(buf, pos)
+        default_is_stmt, pos = u08(buf, pos)
+        self.default_is_stmt = default_is_stmt != 0
+        self.line_base, pos = dwarf.decoder.s08(buf, pos)
+        self.line_range, pos = u08(buf, pos)
+        self.opcode_base, pos = u08(buf, pos)
         
         self.standard_opcode_lengths = []
         for _ in range(self.opcode_base-1):
-            self.standard_opcode_lengths.append(dwarf.u08())
+            length, pos = u08(buf, pos)
+            self.standard_opcode_lengths.append(length)
         
         # Directories
         self.include_directories = []
         while True:
-            string = dwarf.read_string()
+            string, pos = read_string(buf, pos)
             if string == '': break
             self.include_directories.append(string)
         
         # Files
         self.file_names = []
         while True:
-            f = FileEntry(dwarf)
-            if f.name == '': break
+            f, pos = read_file_entry(buf, pos)
+            if f is None: break
             self.file_names.append(f)
+        
+        self.special_opcodes = self.build_special_opcodes()
+    
+    def get_file_path(self, i):
+        """
+        Return the (directory, name) of the file number *i*, with None as the
+        directory for the compilation directory
+        """
+        f = self.file_names[i-1]
+        dir = None
+        if f.directory_index != 0:
+            dir = self.include_directories[f.directory_index - 1]
+        return dir, f.name
+    
+    def build_special_opcodes(self):
+        """
+        Return the (address advance, line advance) of each opcode, None below
+        opcode_base. With one operation per instruction the address advance
+        is in bytes, otherwise it is the operation advance (see advance).
+        """
+        special_opcodes = [None] * 256
+        for opcode in range(self.opcode_base, 256):
+            operation_advance, line_advance = divmod(opcode - self.opcode_base,
+                                                     self.line_range)
+            if self.maximum_operations_per_instruction == 1:
+                operation_advance *= self.min_instr_length
+            special_opcodes[opcode] = (operation_advance, self.line_base + line_advance)
+        return special_opcodes
+    
+    def advance(self, regs, operation_advance):
+        """
+        Advance the address and op_index of *regs* by *operation_advance*
+        """
+        max_ops = self.maximum_operations_per_instruction
+        if max_ops == 1:
+            regs.address += self.min_instr_length * operation_advance
+        else:
+            op_index = regs.op_index + operation_advance
+            regs.address += self.min_instr_length * (op_index // max_ops)
+            regs.op_index = op_index % max_ops
 
 
 class StatementProgram(object):
-    def __init__(self, dwarf, cu):
+    sequences = None
+    line_index = None
+    file_name_index = None
+    
+    def __init__(self, dwarf, buf, pos, cu):
         self.cu = cu
-        self.prog = ProgramPrologue(dwarf)
-        self.matrix = statement_information(dwarf, self.prog)
+        if dwarf.cache is not None:
+            cached = dwarf.cache.get('line-%d' % cu.stmt_list)
+            if cached is not None:
+                self.prog, self.matrix = cached
+                return
+        
+        self.prog = ProgramPrologue(dwarf, buf, pos)
+        self.matrix = statement_information(dwarf, buf, self.prog)
+        if dwarf.cache is not None:
+            dwarf.cache.put('line-%d' % cu.stmt_list, (self.prog, self.matrix))
     
     def get_file_path(self, i):
-        f = self.prog.file_names[i-1]
-        dir = None
-        if f.directory_index != 0:
-            dir = self.prog.include_directories[f.directory_index - 1]
-        return dir, f.name
+        return self.prog.get_file_path(i)
     
     def get_file_index(self, name):
-        for i, f in enumerate(self.prog.file_names):
-            if name.endswith(f.name):
-                return i + 1
+        if self.file_name_index is None:
+            # Only the names with the same base name can be a suffix of name
+            self.file_name_index = {}
+            for i, f in enumerate(self.prog.file_names):
+                self.file_name_index.setdefault(basename(f.name), []).append(i + 1)
+        
+        for i in self.file_name_index.get(basename(name), []):
+            if name.endswith(self.prog.file_names[i-1].name):
+                return i
         raise KeyError('The given filename "%s" is not in the file list.' % (name))
     
     def regs_to_str(self, regs):
@@ -166,30 +385,137 @@ class StatementProgram(object):
             self.cu.get_file_path(regs.file), regs.line, regs.column,
             regs.address, ', '.join(flags))
     
+    def build_sequence_index(self):
+        """
+        Index the sequences of the matrix (rows up to an end_sequence) by
+        start address: seq_starts and sequences, as (first row, end_sequence
+        row), are sorted by start address, seq_max_ends[i] is the highest
+        end address of sequences[:i+1].
+        """
+        addresses = self.matrix.addresses
+        sequences = []
+        first = 0
+        for i, flags in enumerate(self.matrix.flags):
+            if flags & END_SEQUENCE:
+                if i > first:
+                    sequences.append((addresses[first], first, i))
+                first = i + 1
+        sequences.sort()
+        
+        self.seq_starts = [start for start, first, end in sequences]
+        self.sequences = [(first, end) for start, first, end in sequences]
+        self.seq_max_ends = []
+        max_end = 0
+        for first, end in self.sequences:
+            max_end = max(max_end, addresses[end])
+            self.seq_max_ends.append(max_end)
+    
+    def find_sequence(self, addr):
+        """
+        Return the index in sequences of the sequence covering *addr*, or -1
+        """
+        if self.sequences is None:
+            self.build_sequence_index()
+        
+        addresses = self.matrix.addresses
+        i = bisect_right(self.seq_starts, addr) - 1
+        # Sequences can overlap: look back until none can contain addr
+        while i >= 0 and addr < self.seq_max_ends[i]:
+            if addr < addresses[self.sequences[i][1]]:
+                return i
+            i -= 1
+        return -1
+    
+    def get_row_by_addr(self, addr):
+        """
+        Return the index of the matrix row covering *addr*, or None
+        """
+        i = self.find_sequence(addr)
+        if i < 0:
+            return None
+        
+        addresses = self.matrix.addresses
+        first, end = self.sequences[i]
+        row = bisect_left(addresses, addr, first, end)
+        if addresses[row] != addr:
+            row -= 1
+        return row
+    
+    def get_rows_by_addrs(self, addrs):
+        """
+        Return the index of the matrix row covering each of the sorted
+        *addrs* (or None), sweeping the sequences and their rows in address
+        order: the search for an address starts from the previous one while
+        it stays in the same sequence.
+        """
+        addresses = self.matrix.addresses
+        rows = []
+        row = end = 0
+        limit = None # the current sequence covers the addresses below limit
+        for addr in addrs:
+            if limit is None or addr >= limit:
+                i = self.find_sequence(addr)
+                if i < 0:
+                    limit = None
+                    rows.append(None)
+                    continue
+                row, end = self.sequences[i]
+                limit = addresses[end]
+                if i + 1 < len(self.seq_starts):
+                    limit = min(limit, self.seq_starts[i + 1])
+            
+            row = bisect_left(addresses, addr, row, end)
+            if addresses[row] != addr:
+                row -= 1
+            rows.append(row)
+        return rows
+    
     def get_regs_by_addr(self, addr):
-        prev_regs = None
-        for regs in self.matrix:
-            if addr == regs.address:
-                return regs
-            elif prev_regs is not None and addr < regs.address:
-                # Assuming it was ordered by addr
-                return prev_regs
-            prev_regs = regs
+        row = self.get_row_by_addr(addr)
+        if row is not None:
+            return self.matrix[row]
         
         raise KeyError("The given address 0x%x is not contained in this compilation unit %d" % (addr, self.cu.overall_offset))
     
+    def build_line_index(self):
+        """
+        Index the matrix rows by location: line_index maps (file, line) to
+        the sorted addresses of its rows, file_lines maps file to the sorted
+        lines having rows.
+        """
+        m = self.matrix
+        self.line_index = {}
+        for i, flags in enumerate(m.flags):
+            if not flags & END_SEQUENCE:
+                key = (m.files[i], m.lines[i])
+                self.line_index.setdefault(key, []).append(int(m.addresses[i]))
+        
+        self.file_lines = {}
+        for (f, line), addresses in self.line_index.items():
+            addresses.sort()
+            self.file_lines.setdefault(f, []).append(line)
+        for lines in self.file_lines.values():
+            lines.sort()
+    
+    def get_addrs_by_loc(self, f_index, line):
+        """
+        Return the sorted addresses of *line* of file *f_index*; for a line
+        without code, those of the next line having some (as a debugger
+        would place a breakpoint).
+        """
+        if self.line_index is None:
+            self.build_line_index()
+        
+        if (f_index, line) not in self.line_index:
+            lines = self.file_lines.get(f_index, [])
+            i = bisect_left(lines, line)
+            if i == len(lines):
+                raise KeyError("The given location is not contained in this compilation unit %d" % (self.cu.overall_offset))
+            line = lines[i]
+        return self.line_index[(f_index, line)]
+    
     def get_addr_by_loc(self, f_index, line):
-        prev_regs = None
-        for regs in self.matrix:
-            if regs.file == f_index:
-                if line == regs.line:
-                    return regs.address
-                elif prev_regs is not None and line < regs.line:
-                    # Assuming it was ordered by line
-                    return prev_regs.address
-            prev_regs = regs
-        
-        raise KeyError("The given location is not contained in this compilation unit %d" % (self.cu.overall_offset))
+        return self.get_addrs_by_loc(f_index, line)[0]
     
     def get_loc_by_addr(self, addr):
         regs = self.get_regs_by_addr(addr)
@@ -202,5 +528,34 @@ class StatementProgram(object):
 
 
 class StatementProgramLoader(SectionCache):
+    def __init__(self, dwarf, max_entries=None):
+        SectionCache.__init__(self, dwarf, '.debug_line', StatementProgram, 'stmt_list',
+                              max_entries)
+
+
+class SourceFileIndex(object):
     def __init__(self, dwarf):
-        SectionCache.__init__(self, dwarf, '.debug_line', StatementProgram, 'stmt_list')
+        """
+        Index the files of the line tables of all the CUs by base name, as
+        (CU, file index, name, path) tuples. Only the prologues of the line
+        tables are read: the statement programs are decoded when a line is
+        looked up, and the cached tables are left alone.
+        """
+        self.files = {}
+        stmt = dwarf.stmt
+        for cu in dwarf.info.cus:
+            prog = ProgramPrologue(dwarf, stmt.buf, stmt.section_start + cu.stmt_list)
+            for i, f in enumerate(prog.file_names):
+                dir, name = prog.get_file_path(i + 1)
+                if dir is None:
+                    dir = cu.comp_dir
+                entry = (cu, i + 1, f.name, join(dir, name))
+                self.files.setdefault(basename(f.name), []).append(entry)
+    
+    def find(self, filename):
+        """
+        Return the (CU, file index) of the files matching *filename*: either
+        a suffix of it, or having it as a suffix of their path
+        """
+        return [(cu, i) for cu, i, name, path in self.files.get(basename(filename), [])
+                if filename.endswith(name) or path.endswith(filename)]
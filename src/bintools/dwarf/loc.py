@@ -2,7 +2,8 @@
 Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
-from bintools.dwarf.stream import SectionLoader
+from bisect import bisect_right
+from bintools.dwarf.stream import SectionCache
 
 
 class Location(object):
@@ -24,15 +25,15 @@ class BaseAddress(object):
         return 'base addr: %x' % self.addr
 
 
-def locationEntry(dwarf, offset):
+def locationEntry(dwarf, buf, pos, offset):
     """
     Each entry in a location list is either:
       * a base address selection entry
       * an end of list entry
       * a location list entry
     """
-    beginning_address = dwarf.read_addr()
-    ending_address = dwarf.read_addr()
+    beginning_address, pos = dwarf.read_addr(buf, pos)
+    ending_address, pos = dwarf.read_addr(buf, pos)
     
     if beginning_address == dwarf.max_addr:
         """
@@ -40,27 +41,122 @@ def locationEntry(dwarf, offset):
         interpreting the beginning and ending address offsets of subsequent
         entries of the location list.
         """
-        return BaseAddress(ending_address)
+        return BaseAddress(ending_address), pos
     
     if beginning_address == 0 and ending_address == 0:
         # The end of any given location list
-        return None
+        return None, pos
     
-    loc_expr = dwarf.read_expr()
-    return Location(dwarf, beginning_address, ending_address, loc_expr)
+    loc_expr, pos = dwarf.read_expr(buf, pos)
+    return Location(dwarf, beginning_address, ending_address, loc_expr), pos
 
 
-class LocationLoader(SectionLoader):
-    def __init__(self, dwarf):
-        SectionLoader.__init__(self, dwarf, '.debug_loc', locationEntry)
-    
-    def get_loc_list(self, offset):
-        start = self.offset_index_dict[offset]
+class LocationList(object):
+    def __init__(self, dwarf, buf, pos, offset):
+        """
+        Decode the location list at *offset* of .debug_loc: entries holds its
+        Location and BaseAddress entries, stop the position past its end.
+        The Locations are indexed by range, see get_expr_by_addr.
+        """
+        self.offset = offset
+        self.entries = []
         
-        end = start
-        for i in range(start, len(self.entries)):
-            if self.entries[i] is None:
-                end = i
+        # Until a base address selection entry, the ranges are relative to
+        # the base address of the CU, absolute afterwards
+        relative = []
+        absolute = []
+        base = None
+        while True:
+            entry, pos = locationEntry(dwarf, buf, pos, offset)
+            if entry is None:
                 break
+            self.entries.append(entry)
+            if isinstance(entry, BaseAddress):
+                base = entry.addr
+            elif entry.begin_addr < entry.end_addr:
+                if base is None:
+                    relative.append((entry.begin_addr, entry.end_addr, entry))
+                else:
+                    absolute.append((base + entry.begin_addr, base + entry.end_addr, entry))
+        self.stop = pos
         
-        return self.entries[start:end]
+        self.relative = RangeIndex(relative)
+        self.absolute = RangeIndex(absolute)
+    
+    def get_location_by_addr(self, addr, base_address=0):
+        """
+        Return the Location covering *addr*, or None. *base_address* is the
+        base address of the CU using the list (see CU.base_address).
+        """
+        location = self.absolute.get(addr)
+        if location is None:
+            location = self.relative.get(addr - base_address)
+        return location
+    
+    def get_expr_by_addr(self, addr, base_address=0):
+        """
+        Return the location expression valid at *addr*, or None
+        """
+        location = self.get_location_by_addr(addr, base_address)
+        if location is None:
+            return None
+        return location.loc_expr
+    
+    def __str__(self):
+        return '\n'.join(map(str, self.entries))
+
+
+class RangeIndex(object):
+    def __init__(self, ranges):
+        """
+        Index of (begin, end, value) *ranges*, sorted by begin: starts holds
+        their begin addresses and max_ends[i] the highest end of
+        ranges[:i+1], to look back over overlapping ranges.
+        """
+        self.ranges = sorted(ranges, key=lambda r: r[0])
+        self.starts = [r[0] for r in self.ranges]
+        self.max_ends = []
+        max_end = 0
+        for begin, end, value in self.ranges:
+            max_end = max(max_end, end)
+            self.max_ends.append(max_end)
+    
+    def get(self, addr):
+        """
+        Return the value of the range covering *addr*, or None; where ranges
+        overlap, the one starting last wins
+        """
+        i = bisect_right(self.starts, addr) - 1
+        while i >= 0 and addr < self.max_ends[i]:
+            begin, end, value = self.ranges[i]
+            if addr < end:
+                return value
+            i -= 1
+        return None
+
+
+class LocationLoader(SectionCache):
+    def __init__(self, dwarf, max_entries=None):
+        """
+        The location lists are decoded on first request, by offset
+        """
+        SectionCache.__init__(self, dwarf, '.debug_loc', LocationList,
+                              max_entries=max_entries)
+    
+    def get_loc_list(self, offset):
+        """
+        Return the Location and BaseAddress entries of the list at *offset*
+        """
+        return self.get(offset).entries
+    
+    def get_expr_by_addr(self, offset, addr, base_address=0):
+        return self.get(offset).get_expr_by_addr(addr, base_address)
+    
+    def __str__(self):
+        s = ['\n.debug_loc']
+        offset = 0
+        while offset < self.dwarf.sect_dict['.debug_loc'].size:
+            loc_list = self.get(offset)
+            s.append(str(loc_list))
+            offset = loc_list.stop - self.section_start
+        return '\n'.join(s)
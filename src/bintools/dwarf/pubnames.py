@@ -2,42 +2,46 @@
 Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
-from bintools.dwarf.stream import SectionLoader
+from bintools.dwarf.stream import SectionLoader, read_string
 
 
 class PubName(object):
-    def __init__(self, dwarf):
-        self.offset = dwarf.u32()
-        if self.offset == 0:
-            return
-        self.name = dwarf.read_string()
+    def __init__(self, offset, name):
+        self.offset = offset
+        self.name = name
 
     def __str__(self):
         return '%4d: %s' % (self.offset, self.name)
 
 
 class PubNames(object):
-    def __init__(self, dwarf, offset):
-        length = dwarf.u32()
-        stop = dwarf.io.tell() + length
-        dwarf.check_version()
+    def __init__(self, dwarf, buf, pos, offset):
+        length, pos = dwarf.decoder.u32(buf, pos)
+        self.stop = stop = pos + length
+        ver, pos = dwarf.check_version(buf, pos)
         
-        self.info_offset = dwarf.u32()
-        self.info_size = dwarf.u32()
+        self.info_offset, pos = dwarf.decoder.u32(buf, pos)
+        self.info_size, pos = dwarf.decoder.u32(buf, pos)
         
         self.names = {}
-        while dwarf.io.tell() < stop:
-            pn = PubName(dwarf)
-            if pn.offset != 0:
-                self.names[pn.name] = pn
+        while pos < stop:
+            die_offset, pos = dwarf.decoder.u32(buf, pos)
+            if die_offset != 0:
+                name, pos = read_string(buf, pos)
+                self.names[name] = PubName(die_offset, name)
     
     def __str__(self):
         return '\n'.join(['CU: %d' % self.info_offset]+list(map(str, list(self.names.values()))))
 
 
+def pubNamesEntry(dwarf, buf, pos, offset):
+    entry = PubNames(dwarf, buf, pos, offset)
+    return entry, entry.stop
+
+
 class PubNamesLoader(SectionLoader):
     def __init__(self, dwarf):
-        SectionLoader.__init__(self, dwarf, '.debug_pubnames', PubNames)
+        SectionLoader.__init__(self, dwarf, '.debug_pubnames', pubNamesEntry)
     
     def get_die(self, sym):
         for entry in self.entries:
@@ -47,3 +51,11 @@ class PubNamesLoader(SectionLoader):
                 return cu.get_die_by_offset(pubname.offset)
         
         raise KeyError('The given symbol 0x%x is not in the public names list' % sym)
+
+
+class PubTypesLoader(PubNamesLoader):
+    def __init__(self, dwarf):
+        """
+        .debug_pubtypes has the same layout as .debug_pubnames, for types
+        """
+        SectionLoader.__init__(self, dwarf, '.debug_pubtypes', pubNamesEntry)
@@ -6,25 +6,42 @@ from bintools.dwarf.stream import SectionCache
 
 
 class Ranges(object):
-    def __init__(self, dwarf, offset):
+    def __init__(self, dwarf, buf, pos, offset):
         self.entries = []
         
-        base_addr = 0
+        # Until a base address selection entry, the ranges are relative to
+        # the base address of the CU, absolute afterwards
+        self.relative = []
+        self.absolute = []
+        base_addr = None
         while True:
-            start = dwarf.read_addr()
-            end = dwarf.read_addr()
+            start, pos = dwarf.read_addr(buf, pos)
+            end, pos = dwarf.read_addr(buf, pos)
             
             if start == dwarf.max_addr:
                 base_addr = end
             elif start == 0 and end == 0:
                 break
+            elif base_addr is None:
+                self.entries.append((start, end))
+                self.relative.append((start, end))
             else:
                 self.entries.append((base_addr+start, base_addr+end))
+                self.absolute.append((base_addr+start, base_addr+end))
+    
+    def get_pc_ranges(self, base_address=0):
+        """
+        Return the (low, high) address ranges, for a CU of base address
+        *base_address* (see CU.base_address)
+        """
+        return [(base_address+low, base_address+high)
+                for low, high in self.relative] + self.absolute
     
     def __str__(self):
         return '\n'.join(['    0x%08x - 0x%08x' % range for range in self.entries])
 
 
 class RangesLoader(SectionCache):
-    def __init__(self, dwarf):
-        SectionCache.__init__(self, dwarf, '.debug_ranges', Ranges)
+    def __init__(self, dwarf, max_entries=None):
+        SectionCache.__init__(self, dwarf, '.debug_ranges', Ranges,
+                              max_entries=max_entries)
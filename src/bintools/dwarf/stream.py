@@ -2,7 +2,8 @@
 Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
-from io import StringIO
+from struct import Struct
+from collections import OrderedDict
 from bintools.elf.stream import ElfStream
 from bintools.elf.enums import ELFCLASS, ELFDATA
 from bintools.elf.exception import *
@@ -11,158 +12,340 @@ from bintools.dwarf.enums import DW_FORM
 from bintools.dwarf.expressions import Expression
 
 
+# Offset-cursor readers: every reader takes a buffer and an offset into it,
+# and returns (value, new_offset). The buffer can be anything supporting
+# the buffer protocol, slicing and find(): bytes or an mmap object.
+_u08 = Struct('B').unpack_from
+
+def read_uleb128(buf, offset):
+    byte = _u08(buf, offset)[0]
+    if byte < 0x80: # most values fit in one byte
+        return byte, offset + 1
+    
+    result = byte & 0x7F
+    shift = 7
+    while True:
+        offset += 1
+        byte = _u08(buf, offset)[0]
+        result |= ((byte & 0x7F) << shift)
+        if (byte & 0x80) == 0:
+            break
+        shift += 7
+    return result, offset + 1
+
+def read_sleb128(buf, offset):
+    byte = _u08(buf, offset)[0]
+    if byte < 0x80:
+        if byte & 0x40:
+            return byte - 0x80, offset + 1
+        return byte, offset + 1
+    
+    result = byte & 0x7F
+    shift = 7
+    while True:
+        offset += 1
+        byte = _u08(buf, offset)[0]
+        result |= ((byte & 0x7F) << shift)
+        shift += 7
+        if (byte & 0x80) == 0:
+            break
+    
+    if byte & 0x40:
+        result |= -(1 << shift)
+    
+    return result, offset + 1
+
+def read_leb128_many(buf, offset, count, signed=False):
+    """
+    Decode a run of *count* LEB128 values, return (values, new_offset).
+    The bytes are sliced in chunks, instead of unpacked one at a time.
+    """
+    values = []
+    if count == 0:
+        return values, offset
+    
+    result = shift = 0
+    size = 2 * count # most values take one or two bytes
+    while True:
+        chunk = bytearray(buf[offset:offset + size])
+        if not chunk:
+            raise ParseError('Truncated LEB128 value at 0x%x' % offset)
+        for i, byte in enumerate(chunk):
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if byte & 0x80:
+                continue
+            if signed and byte & 0x40:
+                result -= 1 << shift
+            values.append(result)
+            if len(values) == count:
+                return values, offset + i + 1
+            result = shift = 0
+        offset += len(chunk)
+        size = 2 * (count - len(values)) + 8
+
+def read_uleb128_many(buf, offset, count):
+    return read_leb128_many(buf, offset, count)
+
+def read_sleb128_many(buf, offset, count):
+    return read_leb128_many(buf, offset, count, signed=True)
+
+def read_string(buf, offset):
+    end = buf.find(b'\x00', offset)
+    return buf[offset:end].decode('utf8'), end + 1
+
+# Skippers: like the readers, but only return the offset past the value
+def skip_leb128(buf, offset):
+    while _u08(buf, offset)[0] & 0x80:
+        offset += 1
+    return offset + 1
+
+def skip_string(buf, offset):
+    return buf.find(b'\x00', offset) + 1
+
+
+# Default number of interned expressions, see DwarfStream.read_expression
+MAX_EXPRESSIONS = 4096
+
+
 class DwarfStream(object):
-    def __init__(self, addr_size=4):
+    def __init__(self, addr_size=4, max_expressions=MAX_EXPRESSIONS):
+        """
+        Set up the offset-cursor readers for this stream's byte order (see
+        ElfStream.set_endianness) and *addr_size*.
+        At most *max_expressions* Expressions are interned, None for no limit.
+        """
+        dec = self.decoder
         self.addr_size = addr_size
         if addr_size == 1:
-            self.read_addr = self.u08
+            self.read_addr = dec.u08
             self.max_addr = 0xFF
         elif addr_size == 2:
-            self.read_addr = self.u16
+            self.read_addr = dec.u16
             self.max_addr = 0xFFFF
         elif addr_size == 4:
-            self.read_addr = self.u32
+            self.read_addr = dec.u32
             self.max_addr = 0xFFFFFFFF
         elif addr_size == 8:
-            self.read_addr = self.u64
+            self.read_addr = dec.u64
             self.max_addr = 0xFFFFFFFFFFFFFFFF
-
+        
+        # Shared table of the decoded strings: names repeat across the CUs
+        self.strings = {}
+        # Shared table of the expressions by code, see read_expression
+        self.expressions = OrderedDict()
+        self.max_expressions = max_expressions
+        
         if self.bits == ELFCLASS.ELFCLASS32:
             self.CIE_ID = 0xFFFFFFFF
         elif self.bits == ELFCLASS.ELFCLASS64:
             self.CIE_ID = 0xFFFFFFFFFFFFFFFF
         
-        # Read methods aliases
-        self.read_data1 = self.read_ref1 = self.u08
-        self.read_data2 = self.read_ref2 = self.u16
-        self.read_data4 = self.read_ref4 = self.u32
-        self.read_data8 = self.read_ref8 = self.u64
-        self.read_ref_addr = self.read_addr
-        self.read_sdata1 = self.s08
-        self.read_sdata2 = self.s16
-        self.read_sdata4 = self.s32
-        self.read_sdata8 = self.s64
-        self.read_sec_offset = self.u32
-    
-    def check_version(self, handled=[2], bytes=2):
+        # Readers by type name, as used by DW_FORM and the operand tables
+        self.readers = {
+            'addr': self.read_addr,
+            'ref_addr': self.read_addr,
+            'data1': dec.u08, 'ref1': dec.u08,
+            'data2': dec.u16, 'ref2': dec.u16,
+            'data4': dec.u32, 'ref4': dec.u32,
+            'data8': dec.u64, 'ref8': dec.u64,
+            'sdata1': dec.s08,
+            'sdata2': dec.s16,
+            'sdata4': dec.s32,
+            'sdata8': dec.s64,
+            'sec_offset': dec.u32,
+            'sdata': read_sleb128,
+            'udata': read_uleb128,
+            'ref_udata': read_uleb128,
+            'string': self.read_interned_string,
+            'strp': self.read_strp,
+            'flag': self.read_flag,
+            'flag_present': self.read_flag_present,
+            'indirect': self.read_indirect,
+            'block1': self.read_block1,
+            'block2': self.read_block2,
+            'block4': self.read_block4,
+            'block': self.read_block,
+            'exprloc': self.read_exprloc,
+        }
+        self.form_readers = dict((form, self.readers[name])
+                for form, name in DW_FORM.dict.items() if name in self.readers)
+        
+        # Expression readers for the block forms of location attributes
+        self.expr_block_readers = dict((form, self.expr_block_reader(form))
+                for form in (DW_FORM.block1, DW_FORM.block2, DW_FORM.block4, DW_FORM.block))
+        
+        # Sizes of the fixed-size forms, skippers for the variable-size ones
+        sizes = {
+            'addr': addr_size, 'ref_addr': addr_size,
+            'data1': 1, 'ref1': 1, 'sdata1': 1, 'flag': 1,
+            'data2': 2, 'ref2': 2, 'sdata2': 2,
+            'data4': 4, 'ref4': 4, 'sdata4': 4, 'sec_offset': 4, 'strp': 4,
+            'data8': 8, 'ref8': 8, 'sdata8': 8,
+            'flag_present': 0,
+        }
+        skippers = {
+            'sdata': skip_leb128,
+            'udata': skip_leb128,
+            'ref_udata': skip_leb128,
+            'string': skip_string,
+            'indirect': self.skip_indirect,
+            'block1': self.skip_block1,
+            'block2': self.skip_block2,
+            'block4': self.skip_block4,
+            'block': self.skip_block,
+            'exprloc': self.skip_block,
+        }
+        self.form_sizes = dict((form, sizes[name])
+                for form, name in DW_FORM.dict.items() if name in sizes)
+        self.form_skippers = dict((form, skippers[name])
+                for form, name in DW_FORM.dict.items() if name in skippers)
+    
+    def check_version(self, buf, offset, handled=[2], bytes=2):
         if bytes == 1:
-            ver = self.u08()
+            ver, offset = self.decoder.u08(buf, offset)
         elif bytes == 2:
-            ver = self.u16()
+            ver, offset = self.decoder.u16(buf, offset)
         
         if ver not in handled:
             raise ParseError("Unhandled version: %d" % ver)
         
-        return ver
-    
-    def ULEB128(self):
-        result = 0
-        shift = 0
-        while True:
-            byte = self.u08()
-            result |= ((byte & 0x7F) << shift)
-            if (byte & 0x80) == 0:
-                break
-            shift += 7
-        return result
-    
-    def SLEB128(self):
-        result = 0
-        shift = 0
-        while True:
-            byte = self.u08()
-            result |= ((byte & 0x7F) << shift)
-            shift += 7
-            if (byte & 0x80) == 0:
-                break
-        
-        if byte & 0x40:
-            result |= -(1 << shift)
-        
-        return result
-    
-    def read_type(self, type_name):
-        return getattr(self, 'read_'+type_name)()
+        return ver, offset
     
     # Read DW_FORM
-    def read_form(self, form):
-        return self.read_type(DW_FORM[form])
+    def read_form(self, form, buf, offset):
+        return self.form_readers[form](buf, offset)
     
-    read_sdata = SLEB128
-    read_udata = read_ref_udata = ULEB128
+    def read_interned_string(self, buf, offset):
+        string, offset = read_string(buf, offset)
+        return self.strings.setdefault(string, string), offset
     
-    def read_string(self):
-        s = bytearray()
-        while True:
-            c = self.io.read(1)
-            if c[0:1] == b'\x00': break
-            s[len(s):] = c
-        return s.decode('utf8')
+    def read_strp(self, buf, offset):
+        str_offset, offset = self.decoder.u32(buf, offset)
+        return self.debug_str[str_offset], offset
     
-    def read_strp(self):
-        return self.debug_str[self.u32()]
+    def read_flag(self, buf, offset):
+        flag, offset = self.decoder.u08(buf, offset)
+        return (flag != 0), offset
     
-    def read_flag(self):
-        return (self.u08() != 0)
+    def read_flag_present(self, buf, offset): # the attribute is implicitly indicated as present
+        return True, offset
     
-    def read_flag_present(self): # the attribute is implicitly indicated as present
-        return True
+    def read_indirect(self, buf, offset):
+        form, offset = read_uleb128(buf, offset)
+        return self.read_form(form, buf, offset)
     
-    def read_indirect(self):
-        return self.read_form(self.ULEB128())
+    def read_block1(self, buf, offset):
+        length, offset = self.decoder.u08(buf, offset)
+        return buf[offset:offset+length], offset+length
     
-    def read_block1(self):
-        return self.io.read(self.u08())
+    def read_block2(self, buf, offset):
+        length, offset = self.decoder.u16(buf, offset)
+        return buf[offset:offset+length], offset+length
     
-    def read_block2(self):
-        return self.io.read(self.u16())
+    def read_block4(self, buf, offset):
+        length, offset = self.decoder.u32(buf, offset)
+        return buf[offset:offset+length], offset+length
     
-    def read_block4(self):
-        return self.io.read(self.u32())
+    def read_block(self, buf, offset):
+        length, offset = read_uleb128(buf, offset)
+        return buf[offset:offset+length], offset+length
     
-    def read_block(self):
-        return self.io.read(self.ULEB128())
-    
-    def read_expr_block(self, form):
+    def read_expr_block(self, form, buf, offset):
         if   form == DW_FORM.block1:
-            length = self.u08()
+            length, offset = self.decoder.u08(buf, offset)
         elif form == DW_FORM.block2:
-            length = self.u16()
+            length, offset = self.decoder.u16(buf, offset)
         elif form == DW_FORM.block4:
-            length = self.u32()
+            length, offset = self.decoder.u32(buf, offset)
         elif form == DW_FORM.block:
-            length = self.ULEB128()
+            length, offset = read_uleb128(buf, offset)
         else:
             raise ParseError("Not an expression block: %s" % DW_FORM[form])
-        return Expression(self, length)
+        return self.read_expression(buf, offset, length), offset+length
+    
+    def expr_block_reader(self, form):
+        def read(buf, offset):
+            return self.read_expr_block(form, buf, offset)
+        return read
+    
+    def read_expression(self, buf, offset, length):
+        """
+        Return the Expression of the *length* bytes at *offset* of *buf*.
+        The bytes are only copied here: the instructions are decoded on first
+        use, and the same code, as in most variable and member locations,
+        maps to the same interned Expression.
+        Past max_expressions, the least recently read code is dropped from the
+        table: its Expression stays valid, but is no longer shared.
+        """
+        code = bytes(buf[offset:offset+length])
+        expressions = self.expressions
+        expr = expressions.pop(code, None) # back as the most recently used
+        if expr is None:
+            expr = Expression(self, code)
+            if self.max_expressions is not None and len(expressions) >= self.max_expressions:
+                expressions.popitem(last=False)
+        expressions[code] = expr
+        return expr
+    
+    def read_expr(self, buf, offset):
+        length, offset = self.decoder.u16(buf, offset)
+        return self.read_expression(buf, offset, length), offset+length
+    
+    def read_exprloc(self, buf, offset):
+        length, offset = read_uleb128(buf, offset)
+        return self.read_expression(buf, offset, length), offset+length
+    
+    def skip_form(self, form, buf, offset):
+        if form in self.form_sizes:
+            return offset + self.form_sizes[form]
+        return self.form_skippers[form](buf, offset)
+    
+    def skip_indirect(self, buf, offset):
+        form, offset = read_uleb128(buf, offset)
+        return self.skip_form(form, buf, offset)
+    
+    def skip_block1(self, buf, offset):
+        length, offset = self.decoder.u08(buf, offset)
+        return offset + length
     
-    def read_expr(self):
-        return Expression(self, self.u16())
+    def skip_block2(self, buf, offset):
+        length, offset = self.decoder.u16(buf, offset)
+        return offset + length
+    
+    def skip_block4(self, buf, offset):
+        length, offset = self.decoder.u32(buf, offset)
+        return offset + length
+    
+    def skip_block(self, buf, offset):
+        length, offset = read_uleb128(buf, offset)
+        return offset + length
 
-    def read_exprloc(self):
-        return Expression(self, self.ULEB128())
 
 class SectionLoader(object):
     def __init__(self, dwarf, section_name, Entry):
         """
-        Loads all the *Entries* of the given *senction_name*
+        Loads all the *Entries* of the given *senction_name*.
+        Entry(dwarf, buf, pos, offset) decodes the entry at position *pos* of
+        *buf* (*offset* from the section start) and returns (entry, new_pos).
         """
         self.dwarf = dwarf
         self.section_name = section_name
         self.section = dwarf.sect_dict[section_name]
         
-        dwarf.io.seek(self.section.offset)
+        buf, start = dwarf.get_section_buffer(self.section)
+        pos = start
         
         self.entries = []
         self.entries_dict = {}
         self.offset_index_dict = {}
         i = 0
         while True:
-            offset = dwarf.io.tell() - self.section.offset
+            offset = pos - start
             if offset >= self.section.size:
                 break
             
-            entry = Entry(dwarf, offset)
+            entry, pos = Entry(dwarf, buf, pos, offset)
             self.entries.append(entry)
             self.entries_dict[offset] = entry
             
@@ -175,21 +358,27 @@ class SectionLoader(object):
 
 
 class SectionCache(object):
-    def __init__(self, dwarf, section_name, Entry, offset_attr=None):
+    def __init__(self, dwarf, section_name, Entry, offset_attr=None, max_entries=None):
         """
         Init a cache for the given *section_name*'s *Entries*
         The cache lookup, will work on an offset from the section start.
-        Instead of passing the offset number, it is possible to pass an object 
+        Instead of passing the offset number, it is possible to pass an object
         with the given *offset_attr*.
+        Entry(dwarf, buf, pos, key) decodes the entry at position *pos* of *buf*.
+        With *max_entries*, the least recently used entries are evicted past
+        that number, and decoded again on their next lookup. The hits,
+        misses and evictions are counted.
         """
         if section_name not in dwarf.sect_dict:
             return
         self.dwarf = dwarf
         self.section_name = section_name
-        self.section_start = dwarf.sect_dict[section_name].offset
+        self.buf, self.section_start = dwarf.get_section_buffer(dwarf.sect_dict[section_name])
         self.Entry = Entry
         self.offset_attr = offset_attr
-        self.__cache = {}
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = 0
+        self.__cache = OrderedDict()
     
     def get(self, key):
         if self.offset_attr is None:
@@ -197,16 +386,34 @@ class SectionCache(object):
         else:
             offset = getattr(key, self.offset_attr)
         
-        if offset not in self.__cache:
-            self.dwarf.io.seek(self.section_start + offset)
-            self.__cache[offset] = self.Entry(self.dwarf, key)
+        cache = self.__cache
+        if offset in cache:
+            self.hits += 1
+            if self.max_entries is None:
+                return cache[offset]
+            entry = cache.pop(offset) # back as the most recently used
+            cache[offset] = entry
+            return entry
         
-        return self.__cache[offset]
+        self.misses += 1
+        entry = cache[offset] = self.Entry(self.dwarf, self.buf,
+                                           self.section_start + offset, key)
+        if self.max_entries is not None and len(cache) > self.max_entries:
+            cache.popitem(last=False)
+            self.evictions += 1
+        return entry
+    
+    def __len__(self):
+        return len(self.__cache)
 
 
-class DwarfString(DwarfStream, ElfStream, StringIO):
+class DwarfString(DwarfStream, ElfStream):
     def __init__(self, buffer, bits=ELFCLASS.ELFCLASS32, endianness=ELFDATA.ELFDATA2LSB, addr_size=4):
-        StringIO.__init__(self, buffer)
+        """
+        Offset-cursor readers over the bytes *buffer*, which is available as
+        self.buf.
+        """
+        self.buf = buffer
         self.set_bits(bits)
         self.set_endianness(endianness)
         DwarfStream.__init__(self, addr_size)
@@ -214,7 +421,7 @@ class DwarfString(DwarfStream, ElfStream, StringIO):
 
 class DwarfList(DwarfString):
     def __init__(self, list, bits=ELFCLASS.ELFCLASS32, endianness=ELFDATA.ELFDATA2LSB, addr_size=4):
-        buffer = ''.join(map(chr, list))
+        buffer = bytes(bytearray(list))
         DwarfString.__init__(self, buffer, bits, endianness, addr_size)
 
 
@@ -225,6 +432,25 @@ if __name__ == '__main__':
     ]
     
     test_stream = DwarfList(data)
-    assert test_stream.ULEB128() == 624485
-    assert test_stream.SLEB128() == -624485
+    value, offset = read_uleb128(test_stream.buf, 0)
+    assert value == 624485
+    value, offset = read_sleb128(test_stream.buf, offset)
+    assert value == -624485
+    
+    values, offset = read_uleb128_many(test_stream.buf, 0, 2)
+    assert values == [624485, 1472667]
+    assert offset == 6
+    values, offset = read_sleb128_many(test_stream.buf, 3, 1)
+    assert values == [-624485] and offset == 6
+    
+    # Interned expressions, bounded to the most recently read codes
+    test_stream = DwarfList([0x50, 0x51, 0x52])
+    test_stream.max_expressions = 2
+    reg0 = test_stream.read_expression(test_stream.buf, 0, 1)
+    assert test_stream.read_expression(test_stream.buf, 0, 1) is reg0
+    test_stream.read_expression(test_stream.buf, 1, 1)
+    test_stream.read_expression(test_stream.buf, 0, 1)
+    test_stream.read_expression(test_stream.buf, 2, 1)
+    assert list(test_stream.expressions) == [b'\x50', b'\x52']
+    assert test_stream.read_expression(test_stream.buf, 0, 1) is reg0
     print('OK')
@@ -0,0 +1,173 @@
+"""
+Copyright (c) 2010, Cambridge Silicon Radio Ltd.
+Written by Emilio Monti <emilmont@gmail.com>
+"""
+from bisect import bisect_right
+from bintools.dwarf.enums import DW_TAG
+from bintools.dwarf.info import get_pc_ranges
+from bintools.dwarf.loc import LocationList, RangeIndex
+from bintools.dwarf.expressions import Expression
+
+# DIEs holding the variables of a scope, and DIEs opening a nested scope
+VARIABLE_TAGS = (DW_TAG.formal_parameter, DW_TAG.variable)
+SCOPE_TAGS = (DW_TAG.lexical_block, DW_TAG.inlined_subroutine)
+
+
+class Variable(object):
+    def __init__(self, die, location):
+        """
+        Formal parameter or variable *die*, with the value of its location
+        attribute: an Expression, or a LocationList
+        """
+        self.die = die
+        self.location = location
+    
+    @property
+    def name(self):
+        # Concrete instances of inlined variables take their abstract name
+        return self.die.cu.get_function_name(self.die)
+    
+    def get_expr_by_addr(self, addr):
+        """
+        Return the location expression of the variable at *addr*, or None
+        where it has no location
+        """
+        if isinstance(self.location, LocationList):
+            return self.location.get_expr_by_addr(addr, self.die.cu.base_address)
+        return self.location
+    
+    def __str__(self):
+        return '%s %s' % (DW_TAG[self.die.tag], self.name)
+
+
+class SubprogramScopes(object):
+    def __init__(self, cu, index):
+        """
+        The variables of the subprogram DIE number *index* of *cu*, with the
+        address ranges of their innermost scope: lexical block, inlined
+        subroutine, or the subprogram itself.
+        The ranges are split at every scope boundary: bounds holds the sorted
+        boundaries and scopes[i] the variables in scope from bounds[i] up to
+        bounds[i+1], so that a lookup is a bisection.
+        """
+        self.cu = cu
+        self.index = index
+        
+        ranges = []
+        for pc_ranges, variable in self.read_variables():
+            for low, high in pc_ranges:
+                if low < high:
+                    ranges.append((low, high, variable))
+        
+        self.bounds = sorted(set([r[0] for r in ranges] + [r[1] for r in ranges]))
+        scopes = [[] for _ in self.bounds]
+        for low, high, variable in ranges:
+            i = bisect_right(self.bounds, low) - 1
+            while self.bounds[i] < high:
+                scopes[i].append(variable)
+                i += 1
+        self.scopes = [tuple(scope) for scope in scopes]
+    
+    def read_variables(self):
+        """
+        Walk the subtree of the subprogram, in DIE order, and yield the
+        (pc_ranges, Variable) of the DIEs with a location. Nested subprograms
+        have their own SubprogramScopes, their subtrees are skipped.
+        """
+        tree = self.cu.parse_dies()
+        dies = tree.dies
+        levels = tree.die_levels
+        subprogram = dies[self.index]
+        level = subprogram.level
+        
+        # scopes[n]: the ranges of the innermost scope at level + n
+        scopes = [subprogram.get_pc_ranges()]
+        i = self.index + 1
+        while i < len(levels) and levels[i] > level:
+            die = dies[i]
+            depth = levels[i] - level
+            del scopes[depth:]
+            tag = die.tag
+            if tag == DW_TAG.subprogram:
+                i += 1
+                while i < len(levels) and levels[i] > die.level:
+                    i += 1
+                continue
+            if tag in VARIABLE_TAGS:
+                attr_dict = die.attr_dict
+                location = self.read_location(attr_dict)
+                if location is not None:
+                    yield scopes[-1], Variable(die, location)
+            if die.has_children:
+                if tag in SCOPE_TAGS:
+                    pc_ranges = get_pc_ranges(die.attr_dict, self.cu.base_address)
+                    scopes.append(pc_ranges or scopes[-1])
+                else:
+                    scopes.append(scopes[-1])
+            i += 1
+    
+    def read_location(self, attr_dict):
+        """
+        Return the Expression or LocationList of the location attribute in
+        *attr_dict*, or None
+        """
+        if 'location' not in attr_dict:
+            return None
+        location = attr_dict['location']
+        if location.is_loc_list():
+            return self.cu.dwarf.loc.get(location.value)
+        if isinstance(location.value, Expression):
+            return location.value
+        return None
+    
+    def get_variables_by_addr(self, addr):
+        """
+        Return the Variables in scope at *addr*, in DIE order
+        """
+        i = bisect_right(self.bounds, addr) - 1
+        if i < 0:
+            return ()
+        return self.scopes[i]
+
+
+class VariableIndex(object):
+    def __init__(self, cu):
+        """
+        Index of the subprograms of *cu* by address range; the variables of
+        each subprogram are indexed on first lookup in its code.
+        """
+        self.cu = cu
+        self.subprograms = {}
+        
+        ranges = []
+        for die in cu.dies:
+            if die.tag != DW_TAG.subprogram:
+                continue
+            for low, high in die.get_pc_ranges():
+                if low < high:
+                    ranges.append((low, high, die.index))
+        # Nested subprograms start after their parent: the innermost wins
+        self.ranges = RangeIndex(ranges)
+    
+    def get_subprogram_scopes(self, addr):
+        """
+        Return the SubprogramScopes of the subprogram containing *addr*, or
+        None
+        """
+        index = self.ranges.get(addr)
+        if index is None:
+            return None
+        if index not in self.subprograms:
+            self.subprograms[index] = SubprogramScopes(self.cu, index)
+        return self.subprograms[index]
+    
+    def get_variables_by_addr(self, addr):
+        """
+        Return the (Variable, Expression) of the variables in scope at
+        *addr*; the Expression is None where a variable has no location
+        """
+        scopes = self.get_subprogram_scopes(addr)
+        if scopes is None:
+            return []
+        return [(variable, variable.get_expr_by_addr(addr))
+                for variable in scopes.get_variables_by_addr(addr)]
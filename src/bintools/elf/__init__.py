@@ -7,15 +7,28 @@ from bintools.elf.structs import *
 from bintools.elf.exception import ParseError
 from io import FileIO
 from io import StringIO
+import mmap
 import os 
 
 
     
 class ELF(ElfStream):
-    def __init__(self, initer ):
+    def __init__(self, initer, use_mmap=False):
+        """
+        With *use_mmap* a file given by path is memory-mapped instead of read
+        through FileIO: the stream primitives then work on the mapping without
+        a system call per read, and sections are decoded in place (see
+        get_section_buffer).
+        """
+        self.file = None
+        self.map = None
         if isinstance(initer, str):
             #test if initer is path to a file ...
-            if os.path.exists(initer) :
+            if os.path.exists(initer) and use_mmap:
+                self.file = FileIO(initer,'rb')
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                iobj = self.map
+            elif os.path.exists(initer) :
                 iobj = FileIO(initer,'rb')
             else : 
                 # it should be a binary buffer ..
@@ -56,14 +69,31 @@ class ELF(ElfStream):
             count = symtab.size / Symbol.LENGTH
             self.symbols = self.load_entries(symtab.offset, count, Symbol)
 
+    def get_section_buffer(self, section):
+        """
+        Return (buffer, start) to decode *section* with offset cursors: the
+        file mapping and the section offset if memory-mapped, otherwise the
+        section data and 0.
+        """
+        if self.map is not None:
+            return self.map, section.offset
+        return section.data, 0
+
     def __del__(self):
-        if not self.iobj.closed :
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        elif not self.iobj.closed :
             self.iobj.close()
     
     @staticmethod
     def get_from_file(path):
         return ELF(path)
     
+    @staticmethod
+    def get_from_file_mapped(path):
+        return ELF(path, use_mmap=True)
+    
     @staticmethod
     def get_from_file_memory_duplicate(path):
         io = FileIO(path,'rb')
@@ -4,12 +4,45 @@ Written by Emilio Monti <emilmont@gmail.com>
 """
 from sys import exit
 from traceback import print_stack
-from struct import unpack
+from struct import unpack, Struct
 
 from bintools.elf.exception import *
 from bintools.elf.enums import ELFCLASS, ELFDATA
 
+def fixed_reader(fmt):
+    """
+    Offset-cursor reader for the fixed-size *fmt*: takes a buffer and an
+    offset into it and returns (value, new_offset).
+    """
+    st = Struct(fmt)
+    unpack_from = st.unpack_from
+    size = st.size
+    def read(buf, offset):
+        return unpack_from(buf, offset)[0], offset + size
+    return read
+
+
+class Decoder(object):
+    def __init__(self, prefix):
+        """
+        Precompiled offset-cursor readers for the byte order *prefix*
+        ('<' or '>'), see fixed_reader.
+        """
+        self.u08 = fixed_reader('B')
+        self.s08 = fixed_reader('b')
+        self.u16 = fixed_reader(prefix + 'H')
+        self.u32 = fixed_reader(prefix + 'I')
+        self.u64 = fixed_reader(prefix + 'Q')
+        self.s16 = fixed_reader(prefix + 'h')
+        self.s32 = fixed_reader(prefix + 'i')
+        self.s64 = fixed_reader(prefix + 'q')
+
+LITTLE_ENDIAN = Decoder('<')
+BIG_ENDIAN = Decoder('>')
+
+
 class ElfStream(object):
+    map = None # mmap object backing self.io, if memory-mapped
 
     def __init__(self, ioboj):
         self.io = ioboj
@@ -34,6 +67,7 @@ class ElfStream(object):
             self.s16 = self.SLInt16
             self.s32 = self.SLInt32
             self.s64 = self.SLInt64
+            self.decoder = LITTLE_ENDIAN
         elif endianness == ELFDATA.ELFDATA2MSB:
             self.u16 = self.UBInt16
             self.u32 = self.UBInt32
@@ -41,6 +75,7 @@ class ElfStream(object):
             self.s16 = self.SBInt16
             self.s32 = self.SBInt32
             self.s64 = self.SBInt64
+            self.decoder = BIG_ENDIAN
         else:
             raise ParseError("Invalid data encoding")
         self.endianness = endianness
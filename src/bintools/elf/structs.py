@@ -2,10 +2,10 @@
 Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
-from array import array
 from bintools.elf.stream import ParseError
 from bintools.elf.enums import SHT, SHF, MACHINE, ELFCLASS, ELFDATA
 import os
+import mmap
 
 class Header(object):
     
@@ -135,7 +135,7 @@ class SectionHeader(object):
         self.elf.io.seek(self.offset, os.SEEK_SET)
         self.elf.io.read(self.__data)
         self.elf.io.seek(curr_offset, os.SEEK_SET)
-
+    
 class ProgramHeader(object):
     def __init__(self, elf, index):
         self.elf = elf
@@ -244,15 +244,41 @@ class Symbol(object):
 
 
 class StringTable(object):
-    def __init__(self, stream, offset, size):
+    def __init__(self, stream, offset, size, interned=None):
+        """
+        Table of the null-terminated strings in the *size* bytes at *offset*
+        of *stream*, looked up by offset in the table. A memory-mapped
+        stream is searched in place, any other is read once. Every string is
+        decoded once: the strings are memoized by offset, and equal strings
+        at different offsets share the same object, from the *interned* dict
+        if given.
+        """
         self.offset = offset
-        stream.seek(offset)
-        self.table = array('B', stream.read(size))
-        self.max = len(self.table)
+        self.max = size
+        if isinstance(stream, mmap.mmap):
+            self.table = stream
+            self.start = offset
+        else:
+            stream.seek(offset)
+            self.table = stream.read(size)
+            self.start = 0
+        self.strings = {}
+        self.interned = {} if interned is None else interned
     
     def __getitem__(self, key):
+        try:
+            return self.strings[key]
+        except KeyError:
+            pass
+        
         if (key >= self.max):
             raise ParseError('The required index is out of the table: (0x%x) '
                         '+%d (max=%d)' % (self.offset, key, self.max))
-        i = self.table[key:].index(0) + key
-        return self.table[key:i].tostring().decode('utf8')
+        start = self.start + key
+        end = self.table.find(b'\x00', start, self.start + self.max)
+        if end < 0:
+            raise ParseError('Unterminated string in the table: (0x%x) '
+                        '+%d' % (self.offset, key))
+        string = self.table[start:end].decode('utf8')
+        string = self.strings[key] = self.interned.setdefault(string, string)
+        return string
@@ -2,6 +2,7 @@
 Copyright (c) 2010, Cambridge Silicon Radio Ltd.
 Written by Emilio Monti <emilmont@gmail.com>
 """
+from heapq import heappush, heappop
 
 
 class IntegerIntervals(object):
@@ -50,6 +51,49 @@ class IntegerIntervals(object):
         
         self.__intervals.insert(i, (min, max, value))
     
+    def add_intervals(self, intervals):
+        """
+        Bulk insertion of possibly overlapping *intervals*, in O(n log n).
+        Where intervals overlap, the first one (the intervals already present
+        first, then in the given order) keeps the shared part, and the others
+        are clipped or split around it.
+        """
+        intervals = self.__intervals + [i for i in intervals if i[0] <= i[1]]
+        points = set()
+        for min, max, value in intervals:
+            points.add(min)
+            points.add(max + 1)
+        points = sorted(points)
+        starts = sorted((min, priority) for priority, (min, _, _) in enumerate(intervals))
+        
+        result = []
+        active = [] # heap of (priority, max), the first one wins
+        j = 0
+        for k, point in enumerate(points[:-1]):
+            while j < len(starts) and starts[j][0] <= point:
+                priority = starts[j][1]
+                heappush(active, (priority, intervals[priority][1]))
+                j += 1
+            while active and active[0][1] < point:
+                heappop(active)
+            if not active:
+                continue
+            
+            priority = active[0][0]
+            end = points[k + 1] - 1
+            if result and result[-1][3] == priority and result[-1][1] == point - 1:
+                result[-1][1] = end
+            else:
+                result.append([point, end, intervals[priority][2], priority])
+        
+        self.__intervals = [(min, max, value) for min, max, value, _ in result]
+    
+    def __len__(self):
+        return len(self.__intervals)
+    
+    def __iter__(self):
+        return iter(self.__intervals)
+    
     def get(self, addr):
         """
         O(log n) interval look-up
@@ -92,6 +136,23 @@ class Enum(object):
         except KeyError:
             return "0x%x" % key
 
+class lazy_property(object):
+    def __init__(self, func):
+        """
+        Property computed by *func* on first access. The result is stored as
+        an instance attribute of the same name, so later accesses do not go
+        through the descriptor any more.
+        """
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+    
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
 def benchmark(func, *args, **kargs):
     from time import time
     start = time()
@@ -25,6 +25,7 @@ import argparse
 
 import sys, os
 from collections import defaultdict
+from multiprocessing import Pool
 
 DEBUG=False
 
@@ -43,6 +44,11 @@ def parse_arguments():
             help='Input file (ELF)')
     parser.add_argument('cuname', metavar='CUNAME', type=str, 
             help='Compilation unit name', nargs='*')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+            help='Convert compilation units in N worker processes')
+    parser.add_argument('--cache-dir', metavar='DIR', type=str, default=None,
+            help='Cache the DWARF indexes in DIR, for faster later runs; DIR is read '
+                 'with pickle and must only be writable by trusted users')
     return parser.parse_args()        
 
 from bintools.dwarf import DWARF
@@ -284,11 +290,11 @@ def array_ref(ref, counts=[]):
     return lambda x: c_ast.ArrayDecl(ref(x), dim=[(lambda x : IntConst(x))(x) for x in counts])
 
 # Main conversion function
-def parse_dwarf(infile, cuname):
+def parse_dwarf(infile, cuname, jobs=1, cache_dir=None):
     if not os.path.isfile(infile):
         error("No such file %s" % infile)
         exit(1)
-    dwarf = DWARF(infile)
+    dwarf = DWARF(infile, use_mmap=True, cache_dir=cache_dir)
     # Keep track of what has been written to the syntax tree
     # Indexed by (tag,name)
     # Instead of using this, it may be better to just collect and
@@ -304,6 +310,8 @@ def parse_dwarf(infile, cuname):
         if cu is None:
             print("Can't find compilation unit %s" % cuname, file=sys.stderr)
         statements = process_compile_unit(dwarf, cu, written)
+    elif jobs > 1:
+        statements = parse_dwarf_parallel(infile, dwarf, written, jobs, cache_dir)
     else:
         statements = []
         for cu in dwarf.info.cus:
@@ -311,13 +319,21 @@ def parse_dwarf(infile, cuname):
             statements.extend(process_compile_unit(dwarf, cu, written))
     return statements
 
-def process_compile_unit(dwarf, cu, written):
-    cu_die = cu.compile_unit
+# Only the parameters of a function are converted, so the subtrees of the
+# scopes inside its body need not be parsed. The types declared directly in
+# the body, or in the parameter list, keep their members.
+FUNCTION_BODY_SCOPES = [DW_TAG.lexical_block, DW_TAG.inlined_subroutine,
+                        DW_TAG.call_site]
+
+def compile_unit_roots(cu):
+    '''
+    Iterate over the named top-level DIEs of a compilation unit, as
+    (die, name) tuples.
+    '''
+    tree = cu.parse_dies(prune=FUNCTION_BODY_SCOPES)
+    cu_die = tree.root
     c_file = cu.name # cu name is main file path
-    statements = []
     prev_decl_file = object()
-    # Generate actual syntax tree
-    names = {} # Defined names for dies, as references, indexed by offset
     for child in cu_die.children:
         decl_file_id = get_int(child, 'decl_file')
         decl_file = cu.get_file_path(decl_file_id) if decl_file_id is not None else None
@@ -334,12 +350,79 @@ def process_compile_unit(dwarf, cu, written):
         '''
         name = get_str(child, 'name')
         if name is not None: # non-anonymous
-            if DEBUG:
-                print("root", child.offset)
-            if written[(child.tag, name)] != WRITTEN_FINAL:
-                to_c_process(child, cu.dies_dict, names, statements, written)
+            yield child, name
 
         prev_decl_file = decl_file
+
+def process_compile_unit(dwarf, cu, written):
+    statements = []
+    # Generate actual syntax tree
+    names = {} # Defined names for dies, as references, indexed by offset
+    for child, name in compile_unit_roots(cu):
+        if DEBUG:
+            print("root", child.offset)
+        if written[(child.tag, name)] != WRITTEN_FINAL:
+            to_c_process(child, child.tree.dies_dict, names, statements, written)
+    return statements
+
+# Parallel conversion
+#     Every worker converts whole compilation units, as process_compile_unit
+#     does, but without knowing what was written by the compilation units
+#     before it. The statements are returned together with the (tag,name) and
+#     WRITTEN_* level each of them was written at, and the parent replays
+#     them in compilation unit order against the real written state, dropping
+#     what an earlier compilation unit already wrote. As for the serial
+#     deduplication, this assumes that a (tag,name) denotes the same type in
+#     every compilation unit.
+class WrittenLog(dict):
+    '''written dictionary that logs every (key, level) assignment'''
+    def __init__(self):
+        dict.__init__(self)
+        self.log = []
+
+    def __missing__(self, key):
+        return WRITTEN_NONE
+
+    def __setitem__(self, key, level):
+        self.log.append((key, level))
+        dict.__setitem__(self, key, level)
+
+worker_dwarf = None
+
+def init_worker(infile, cache_dir):
+    global worker_dwarf
+    worker_dwarf = DWARF(infile, use_mmap=True, cache_dir=cache_dir)
+
+def process_compile_unit_worker(overall_offset):
+    '''
+    Convert the compilation unit at overall_offset in a worker process.
+    Returns (cu name, statements, written log), for replay_compile_unit:
+    every statement is appended together with a written assignment.
+    '''
+    cu = worker_dwarf.info.get_cu_by_offset(overall_offset)
+    written = WrittenLog()
+    statements = process_compile_unit(worker_dwarf, cu, written)
+    return cu.name, statements, written.log
+
+def replay_compile_unit(statements, log, written):
+    replayed = []
+    for statement, (key, level) in zip(statements, log):
+        if key[1] is None or written[key] < level:
+            replayed.append(statement)
+            written[key] = level
+    return replayed
+
+def parse_dwarf_parallel(infile, dwarf, written, jobs, cache_dir):
+    offsets = [cu.overall_offset for cu in dwarf.info.cus]
+    statements = []
+    pool = Pool(jobs, init_worker, (infile, cache_dir))
+    try:
+        for name, cu_statements, log in pool.imap(process_compile_unit_worker, offsets):
+            progress("Processing %s" % name)
+            statements.extend(replay_compile_unit(cu_statements, log, written))
+        pool.close()
+    finally:
+        pool.terminate()
     return statements
 
 def generate_c_code(statements):
@@ -352,7 +435,7 @@ def main():
     # The main idea is to convert the DWARF tree to a C syntax tree, then 
     # generate C code using cgen
     args = parse_arguments()
-    statements = parse_dwarf(args.input,args.cuname)
+    statements = parse_dwarf(args.input,args.cuname,args.jobs,args.cache_dir)
     ast = generate_c_code(statements)
     progress('Generating output')
     sys.stdout.write(CGenerator().visit(ast))
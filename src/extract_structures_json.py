@@ -7,6 +7,7 @@ pretty-printer.
 from __future__ import print_function, division, unicode_literals
 import argparse
 import os, sys
+from collections import defaultdict
 from bintools.dwarf import DWARF
 from bintools.dwarf.enums import DW_AT, DW_TAG, DW_LANG, DW_ATE, DW_FORM, DW_OP, DW_ATE
 from dwarfhelpers import get_flag, get_str, get_int, get_ref, not_none, expect_str
@@ -32,7 +33,8 @@ def type_name(die):
         return 'void' # predefined nothing type
     type_name = get_str(die, 'name')
     if type_name is None: # Make up a name if it is not provided by DWARF
-        return '%s_%i' % (DW_TAG[die.tag], die.offset)
+        # from the .debug_info offset, unique across the compile units
+        return '%s_%i' % (DW_TAG[die.tag], die.cu.overall_offset + die.offset)
     return type_name
 
 def parse_type(type, dies_dict):
@@ -138,19 +140,13 @@ def visit_structure_type(die,dies_dict):
     return type_info
 
 def process_compile_unit(dwarf, cu, roots):
-    cu_die = cu.compile_unit
+    tree = cu.parse_dies(prune=[DW_TAG.subprogram]) # function bodies hold no root types
     # Generate actual syntax tree
     global worklist
     global visited
     types = {}
-    worklist = []
-    for child in cu_die.children:
-        visited = set()
-
-        name = get_str(child, 'name')
-        if name is not None: # non-anonymous
-            if name in roots: # nest into this structure
-                worklist.append(child)
+    visited = set()
+    worklist = [tree.get_die_by_offset(offset) for offset in roots]
               
     while worklist:
         die = worklist.pop()
@@ -163,13 +159,13 @@ def process_compile_unit(dwarf, cu, roots):
         if DEBUG:
             print("[%s]" % (type_name(die)))
         if die.tag in [DW_TAG.structure_type, DW_TAG.union_type]:
-            type_info = visit_structure_type(die, cu.dies_dict)
+            type_info = visit_structure_type(die, tree.dies_dict)
         elif die.tag in [DW_TAG.base_type]:
-            type_info = visit_base_type(die, cu.dies_dict)
+            type_info = visit_base_type(die, tree.dies_dict)
         elif die.tag in [DW_TAG.array_type]:
-            type_info = visit_array_type(die, cu.dies_dict)
+            type_info = visit_array_type(die, tree.dies_dict)
         elif die.tag in [DW_TAG.enumeration_type]:
-            type_info = visit_enumeration_type(die, cu.dies_dict)
+            type_info = visit_enumeration_type(die, tree.dies_dict)
         else:
             warning('%s not handled' % DW_TAG[die.tag])
             type_info = {}
@@ -181,19 +177,29 @@ def process_compile_unit(dwarf, cu, roots):
 
 
 # Main conversion function
-def parse_dwarf(infile, roots):
+def parse_dwarf(infile, roots, cache_dir=None):
     if not os.path.isfile(infile):
         error("No such file %s" % infile)
         exit(1)
-    dwarf = DWARF(infile)
+    dwarf = DWARF(infile, cache_dir=cache_dir)
+
+    # Look up the roots in the global type index, they can be defined in
+    # different compile units
+    index = dwarf.type_index
+    if not all(x in index for x in roots):
+        return None # not found
+    roots_by_cu = defaultdict(list)
+    for root in roots:
+        cu_offset, die_offset = index.types[root]
+        roots_by_cu[cu_offset].append(die_offset)
 
-    for cu in dwarf.info.cus:
+    types = {}
+    for cu_offset in sorted(roots_by_cu):
+        cu = dwarf.info.get_cu_by_offset(cu_offset)
         progress("Processing %s" % cu.name)
-        types = process_compile_unit(dwarf, cu, roots)
-        if all(x in types for x in roots): # return if all roots found
-            return types
-
-    return None # not found
+        for name, type_info in process_compile_unit(dwarf, cu, roots_by_cu[cu_offset]).items():
+            types.setdefault(name, type_info)
+    return types
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Extract structures from DWARF as parseable format')
@@ -201,14 +207,17 @@ def parse_arguments():
             help='Input file (ELF)')
     parser.add_argument('roots', metavar='ROOT', type=str, nargs='+',
             help='Root data structure name')
+    parser.add_argument('--cache-dir', metavar='DIR', type=str, default=None,
+            help='Cache the DWARF indexes in DIR, for faster later runs; DIR is read '
+                 'with pickle and must only be writable by trusted users')
     return parser.parse_args()        
 
 def main():
     import json
     args = parse_arguments()
-    types = parse_dwarf(args.input, args.roots)
+    types = parse_dwarf(args.input, args.roots, args.cache_dir)
     if types == None:
-        error('Did not find all roots (%s) in any compile unit' % args.roots)
+        error('Did not find all roots (%s)' % args.roots)
         exit(1)
     json.dump(types, sys.stdout,
             sort_keys=True, indent=4, separators=(',', ': '))
@@ -44,6 +44,9 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Find usages of inline functions')
     parser.add_argument('input', metavar='INPUT', type=str,
             help='ELF input file')
+    parser.add_argument('--cache-dir', metavar='DIR', type=str, default=None,
+            help='Cache the DWARF indexes in DIR, for faster later runs; DIR is read '
+                 'with pickle and must only be writable by trusted users')
     return parser.parse_args()
 
 def ip_range(die):
@@ -94,21 +97,26 @@ def process(die, by_offset, depth):
     for child in die.children:
         process(child, by_offset, depth+1)
 
+def outside_functions(die):
+    '''Only the subtrees of functions are visited'''
+    return die.level == 1 and die.tag != DW_TAG.subprogram
+
 def process_compile_unit(dwarf, cu, out):
-    cu_die = cu.compile_unit
+    tree = cu.parse_dies(prune=outside_functions)
+    cu_die = tree.root
     c_file = cu.name # cu name is main file path
     for child in cu_die.children:
         name = get_str(child, 'name')
         if (name is not None and child.tag == DW_TAG.subprogram and 
             'low_pc' in child.attr_dict): # non-anonymous function with memory address
-            process(child, cu.dies_dict, 0)
+            process(child, tree.dies_dict, 0)
             print()
 
-def parse_dwarf(infile, out):
+def parse_dwarf(infile, out, cache_dir=None):
     if not os.path.isfile(infile):
         error("No such file %s" % infile)
         exit(1)
-    dwarf = DWARF(infile)
+    dwarf = DWARF(infile, cache_dir=cache_dir)
     # inline functions are restricted to usage within a compilation unit,
     # no need to keep state between them
     for cu in dwarf.info.cus:
@@ -122,7 +130,7 @@ def main():
     # The main idea is to iterate over the DWARF tree, inside subprograms,
     # and find usage of inline functions
     args = parse_arguments()
-    parse_dwarf(args.input, sys.stdout)
+    parse_dwarf(args.input, sys.stdout, args.cache_dir)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,368 @@
+#!/usr/bin/python
+"""
+Micro benchmarks of the DWARF decoding, run with src in PYTHONPATH:
+    PYTHONPATH=src python test/benchmark.py dies [--baseline] ELF
+    PYTHONPATH=src python test/benchmark.py symbolize ELF
+    PYTHONPATH=src python test/benchmark.py leb128
+    PYTHONPATH=src python test/benchmark.py expr ELF
+"""
+from __future__ import print_function
+import argparse
+import random
+from time import time
+
+from struct import Struct
+
+from bintools.dwarf import DWARF
+from bintools.dwarf.enums import DW_AT, DW_FORM
+from bintools.dwarf.info import Attrib
+from bintools.dwarf.expressions import Expression, Machine
+from bintools.dwarf.loc import Location
+from bintools.elf.exception import ParseError
+from bintools.dwarf.stream import (read_uleb128, read_sleb128, read_string,
+        read_uleb128_many, read_sleb128_many)
+
+
+def best_of(repeat, func, *args):
+    """
+    Run func(*args) *repeat* times, return (best time, last result)
+    """
+    best = None
+    for i in range(repeat):
+        start = time()
+        result = func(*args)
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def report(name, count, unit, elapsed):
+    print('%-24s %10d %s in %.3fs: %12.0f %s/s' %
+          (name, count, unit, elapsed, count / elapsed, unit))
+
+
+# DIE decoding ###################################################
+def parse_trees(path):
+    dwarf = DWARF(path)
+    count = 0
+    for cu in dwarf.info.cus:
+        count += len(cu.dies)
+    return count
+
+def decode_attributes(path):
+    dwarf = DWARF(path)
+    count = 0
+    for cu in dwarf.info.cus:
+        for die in cu.dies:
+            die.attr
+            count += 1
+    return count
+
+EXPR_ATTRIBUTES = ('location', 'data_member_location', 'frame_base')
+
+def read_attributes_by_form(cu, abbr, pos):
+    """
+    Reference decoder of the attributes of a DIE, with a read_form call and
+    the name lookups for each attribute
+    """
+    dwarf = cu.dwarf
+    attr = []
+    for attrib_form in abbr.attrib_forms:
+        name = DW_AT[attrib_form.name_id]
+        form = DW_FORM[attrib_form.form]
+        if name in EXPR_ATTRIBUTES and form[0:5] == 'block':
+            value, pos = dwarf.read_expr_block(attrib_form.form, cu.buf, pos)
+        else:
+            value, pos = dwarf.read_form(attrib_form.form, cu.buf, pos)
+        attr.append(Attrib(cu, attrib_form, value))
+    return attr
+
+def walk_by_form(path, decode):
+    """
+    Reference DIE walk, decoding every attribute value to find the next
+    DIE, as before the abbreviations were compiled. With *decode*, the
+    attributes of each DIE are then decoded with read_attributes_by_form.
+    The tree layout is not recorded, which slightly favours the reference.
+    """
+    dwarf = DWARF(path)
+    read_form = dwarf.read_form
+    count = 0
+    for cu in dwarf.info.cus:
+        buf = cu.buf
+        abbrevs = cu.abbrevs
+        pos = cu.dies_start
+        while pos < cu.stop:
+            code, pos = read_uleb128(buf, pos)
+            if code == 0:
+                continue
+            abbr = abbrevs[code]
+            start = pos
+            for attrib_form in abbr.attrib_forms:
+                pos = read_form(attrib_form.form, buf, pos)[1]
+            if decode:
+                read_attributes_by_form(cu, abbr, start)
+            count += 1
+    return count
+
+def bench_dies(args):
+    if args.baseline:
+        elapsed, count = best_of(args.repeat, walk_by_form, args.input, False)
+        report('DIE walk by form', count, 'DIEs', elapsed)
+    elapsed, count = best_of(args.repeat, parse_trees, args.input)
+    report('DIE tree', count, 'DIEs', elapsed)
+    if args.baseline:
+        elapsed, count = best_of(args.repeat, walk_by_form, args.input, True)
+        report('DIE walk + attributes', count, 'DIEs', elapsed)
+    elapsed, count = best_of(args.repeat, decode_attributes, args.input)
+    report('DIE tree + attributes', count, 'DIEs', elapsed)
+
+
+# Address symbolization ##########################################
+def sample_addresses(path, count, seed):
+    """
+    Return *count* random addresses within the CU ranges of *path*, in the
+    order of a profile: samples often repeat the same hot addresses
+    """
+    intervals = list(DWARF(path).cu_ranges.intervals)
+    rng = random.Random(seed)
+    hot = []
+    for i in range(max(1, count // 10)):
+        first, last, cu_offset = rng.choice(intervals)
+        hot.append(rng.randrange(first, last + 1))
+    return [rng.choice(hot) for i in range(count)]
+
+def symbolize_each(path, addresses):
+    dwarf = DWARF(path)
+    for addr in addresses:
+        try:
+            dwarf.get_loc_by_addr(addr)
+        except KeyError:
+            pass
+    return len(addresses)
+
+def symbolize_many(path, addresses):
+    return len(DWARF(path).symbolize_many(addresses))
+
+def bench_symbolize(args):
+    addresses = sample_addresses(args.input, args.count, args.seed)
+    elapsed, count = best_of(args.repeat, symbolize_many, args.input, addresses)
+    report('symbolize_many', count, 'addresses', elapsed)
+    if not args.skip_single:
+        single = addresses[:args.count // 10]
+        elapsed, count = best_of(args.repeat, symbolize_each, args.input, single)
+        report('get_loc_by_addr', count, 'addresses', elapsed)
+
+
+# LEB128 and string decoding #####################################
+_u08 = Struct('B').unpack_from
+
+def read_uleb128_bytewise(buf, offset):
+    """
+    Reference decoder, unpacking one byte per iteration
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = _u08(buf, offset)[0]
+        offset += 1
+        result |= ((byte & 0x7F) << shift)
+        if (byte & 0x80) == 0:
+            break
+        shift += 7
+    return result, offset
+
+def read_sleb128_bytewise(buf, offset):
+    result = 0
+    shift = 0
+    while True:
+        byte = _u08(buf, offset)[0]
+        offset += 1
+        result |= ((byte & 0x7F) << shift)
+        shift += 7
+        if (byte & 0x80) == 0:
+            break
+    if byte & 0x40:
+        result |= -(1 << shift)
+    return result, offset
+
+def read_string_bytewise(buf, offset):
+    s = bytearray()
+    while True:
+        byte = _u08(buf, offset)[0]
+        offset += 1
+        if byte == 0:
+            break
+        s.append(byte)
+    return s.decode('utf8'), offset
+
+def encode_leb128(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+            out.append(byte)
+            return out
+        out.append(byte | 0x80)
+
+def sample_leb128(count, seed, signed):
+    """
+    Return the encoding of *count* random values, sized like in DWARF:
+    mostly one byte, some two bytes, a few more
+    """
+    rng = random.Random(seed)
+    data = bytearray()
+    for i in range(count):
+        bits = rng.choice([6] * 14 + [13] * 5 + [27])
+        value = rng.randrange(1 << bits)
+        if signed and rng.random() < 0.5:
+            value = -value - 1
+        data += encode_leb128(value)
+    return bytes(data)
+
+def sample_strings(count, seed):
+    rng = random.Random(seed)
+    names = [('%s_%d' % (rng.choice(['int', 'size_t', 'buffer', 'next']), i)).encode('ascii')
+             for i in range(count)]
+    return b'\x00'.join(names) + b'\x00'
+
+def read_each(reader, buf, count):
+    pos = 0
+    for i in range(count):
+        value, pos = reader(buf, pos)
+    return count
+
+def read_many(reader, buf, count):
+    values, pos = reader(buf, 0, count)
+    return len(values)
+
+def bench_leb128(args):
+    for signed, bytewise, reader, reader_many in (
+            (False, read_uleb128_bytewise, read_uleb128, read_uleb128_many),
+            (True, read_sleb128_bytewise, read_sleb128, read_sleb128_many)):
+        kind = 'SLEB128' if signed else 'ULEB128'
+        buf = sample_leb128(args.count, args.seed, signed)
+        elapsed, count = best_of(args.repeat, read_each, bytewise, buf, args.count)
+        report(kind + ' bytewise', count, 'values', elapsed)
+        elapsed, count = best_of(args.repeat, read_each, reader, buf, args.count)
+        report(kind + ' one by one', count, 'values', elapsed)
+        elapsed, count = best_of(args.repeat, read_many, reader_many, buf, args.count)
+        report(kind + ' bulk', count, 'values', elapsed)
+    
+    buf = sample_strings(args.count, args.seed)
+    elapsed, count = best_of(args.repeat, read_each, read_string_bytewise, buf, args.count)
+    report('strings bytewise', count, 'strings', elapsed)
+    elapsed, count = best_of(args.repeat, read_each, read_string, buf, args.count)
+    report('strings', count, 'strings', elapsed)
+
+
+# Expression evaluation ##########################################
+class BenchMachine(Machine):
+    def read_reg(self, reg):
+        return 0x10000 + 8 * reg
+    
+    def read_fbreg(self):
+        return 0x7ff0
+    
+    def read_cfa(self):
+        return 0x8000
+    
+    def read_addr(self, addr, size=None, addr_space_id=None):
+        return addr ^ 0x5555
+
+def sample_expressions(path, count, seed):
+    """
+    Return *count* expressions drawn from the DIE attributes and the
+    location lists of *path*, with the frequencies they have there
+    """
+    dwarf = DWARF(path)
+    corpus = []
+    for cu in dwarf.info.cus:
+        for die in cu.dies:
+            for attr in die.attr:
+                if isinstance(attr.value, Expression):
+                    corpus.append(attr.value)
+                elif attr.is_loc_list():
+                    corpus.extend(entry.loc_expr for entry in
+                            dwarf.loc.get_loc_list(attr.value)
+                            if isinstance(entry, Location))
+    evaluable = []
+    for expr in corpus:
+        try:
+            expr.program
+        except ParseError:
+            continue
+        evaluable.append(expr)
+    rng = random.Random(seed)
+    return [rng.choice(evaluable) for i in range(count)]
+
+def evaluate_decoded(exprs):
+    # Each expression decoded and compiled anew, as without the caching
+    machine = BenchMachine()
+    for expr in exprs:
+        Expression(expr.dwarf, expr.code).evaluate(0x1000, machine)
+    return len(exprs)
+
+def evaluate_compiled(exprs):
+    machine = BenchMachine()
+    for expr in exprs:
+        expr.evaluate(0x1000, machine)
+    return len(exprs)
+
+def bench_expr(args):
+    exprs = sample_expressions(args.input, args.count, args.seed)
+    print('%d expressions, %d distinct' % (len(exprs), len(set(map(id, exprs)))))
+    elapsed, count = best_of(args.repeat, evaluate_decoded, exprs)
+    report('decode + evaluate', count, 'evaluations', elapsed)
+    elapsed, count = best_of(args.repeat, evaluate_compiled, exprs)
+    report('compiled evaluate', count, 'evaluations', elapsed)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='DWARF decoding benchmarks')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='runs per measure, the best one is reported')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    dies = subparsers.add_parser('dies', help='DIEs decoded per second')
+    dies.add_argument('input', metavar='INPUT', help='ELF input file')
+    dies.add_argument('--baseline', action='store_true',
+            help='also measure the reference decoding by form')
+    dies.set_defaults(func=bench_dies)
+
+    symbolize = subparsers.add_parser('symbolize',
+            help='addresses symbolized per second')
+    symbolize.add_argument('input', metavar='INPUT', help='ELF input file')
+    symbolize.add_argument('-n', '--count', type=int, default=100000,
+            help='number of sampled addresses')
+    symbolize.add_argument('--seed', type=int, default=0,
+            help='seed of the address sampling')
+    symbolize.add_argument('--skip-single', action='store_true',
+            help='do not measure the lookups one address at a time')
+    symbolize.set_defaults(func=bench_symbolize)
+
+    leb128 = subparsers.add_parser('leb128',
+            help='LEB128 values and strings decoded per second')
+    leb128.add_argument('-n', '--count', type=int, default=200000,
+            help='number of values decoded')
+    leb128.add_argument('--seed', type=int, default=0,
+            help='seed of the value sampling')
+    leb128.set_defaults(func=bench_leb128)
+
+    expr = subparsers.add_parser('expr',
+            help='DWARF expressions evaluated per second')
+    expr.add_argument('input', metavar='INPUT', help='ELF input file')
+    expr.add_argument('-n', '--count', type=int, default=100000,
+            help='number of sampled expressions')
+    expr.add_argument('--seed', type=int, default=0,
+            help='seed of the expression sampling')
+    expr.set_defaults(func=bench_expr)
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
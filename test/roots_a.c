@@ -0,0 +1,10 @@
+/* Anonymous member types, at the same DIE offset as in roots_b.c */
+struct A
+{
+    struct
+    {
+        int x;
+    } s;
+};
+
+struct A a;
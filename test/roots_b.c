@@ -0,0 +1,10 @@
+/* Anonymous member types, at the same DIE offset as in roots_a.c */
+struct B
+{
+    struct
+    {
+        char x;
+    } s;
+};
+
+struct B b;
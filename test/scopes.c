@@ -0,0 +1,21 @@
+/* gcc scopes.c -gdwarf-4 -O0 -o scopes */
+
+/* The goto splits the loop body: its lexical block has DW_AT_ranges */
+int sum_doubles(int n)
+{
+    struct step { int by; } step = { 2 }; /* a type of the function body */
+    int s = 0;
+    for (int i = 0; i < n; i++) {
+        int repeats = i * step.by;
+        if (repeats > 10)
+            goto out;
+        s += repeats; /* in the repeats block */
+    }
+out:
+    return s;
+}
+
+int main(int argc, char **argv)
+{
+    return sum_doubles(argc);
+}
@@ -0,0 +1,112 @@
+"""
+IndexCache tests, run with src in PYTHONPATH:
+    PYTHONPATH=src python -m unittest discover -s test -p 'test_*.py'
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from bintools.dwarf import DWARF
+from bintools.dwarf import cache
+
+from test_dies import CompiledTestCase
+
+
+class CacheTestCase(CompiledTestCase):
+    def setUp(self):
+        CompiledTestCase.setUp(self)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+
+class PathKeyTest(CacheTestCase):
+    # Without build-id, the entries are keyed on the path
+    cflags = CompiledTestCase.cflags + ['-Wl,--build-id=none']
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.hashed = []
+        file_hash = cache.file_hash
+        def counting_file_hash(path):
+            self.hashed.append(path)
+            return file_hash(path)
+        cache.file_hash = counting_file_hash
+        self.addCleanup(setattr, cache, 'file_hash', file_hash)
+        self.elf = os.path.join(self.cache_dir, 'elf')
+        shutil.copy(self.path, self.elf)
+
+    def open(self):
+        dwarf = DWARF(self.elf, cache_dir=self.cache_dir)
+        dwarf.info.cus # cached on first use
+        return dwarf.cache
+
+    def open_entry(self):
+        # The cache entry alone, before the DWARF indexes are cached
+        return cache.IndexCache(self.cache_dir).open(DWARF(self.elf), self.elf)
+
+    def test_unchanged_file_is_not_hashed(self):
+        entry = self.open()
+        self.assertEqual(len(self.hashed), 1)
+        self.assertEqual(self.open().directory, entry.directory)
+        self.assertEqual(len(self.hashed), 1)
+        self.assertTrue(entry.get('cus') is not None)
+
+    def test_touched_file_keeps_entry(self):
+        self.open()
+        stat = os.stat(self.elf)
+        os.utime(self.elf, (stat.st_atime, stat.st_mtime + 10))
+        entry = self.open()
+        self.assertEqual(len(self.hashed), 2)
+        self.assertTrue(entry.get('cus') is not None)
+
+    def test_changed_file_resets_entry(self):
+        self.open()
+        with open(self.elf, 'ab') as f:
+            f.write(b'\0')
+        entry = self.open_entry()
+        self.assertEqual(len(self.hashed), 2)
+        self.assertTrue(entry.get('cus') is None)
+
+
+class EvictTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def make_entry(self, name):
+        entry = cache.IndexCacheEntry(os.path.join(self.cache_dir, name))
+        entry.put('index', list(range(1000)))
+        return entry
+
+    def test_evict_to_max_size(self):
+        self.make_entry('old')
+        self.make_entry('new')
+        cache.IndexCache(self.cache_dir, max_size=0).evict(keep='new')
+        self.assertEqual(os.listdir(self.cache_dir), ['new'])
+
+    def test_evict_skips_entries_removed_meanwhile(self):
+        self.make_entry('old')
+        self.make_entry('new')
+        # Another process removes the entries while they are listed
+        getmtime = os.path.getmtime
+        def racing_getmtime(path):
+            cache.remove_entry(path)
+            return getmtime(path)
+        os.path.getmtime = racing_getmtime
+        try:
+            cache.IndexCache(self.cache_dir, max_size=0).evict()
+        finally:
+            os.path.getmtime = getmtime
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_write_to_removed_entry(self):
+        entry = self.make_entry('gone')
+        cache.remove_entry(entry.directory)
+        cache.remove_entry(entry.directory)
+        entry.put('index', [])
+        self.assertTrue(entry.get('index') is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
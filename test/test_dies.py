@@ -0,0 +1,121 @@
+"""
+DIE tree parsing tests, run with src in PYTHONPATH:
+    PYTHONPATH=src python -m unittest discover -s test -p 'test_*.py'
+The ELF files are compiled from the C files of this directory, the tests
+are skipped without gcc.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from bintools.dwarf import DWARF
+from bintools.dwarf.enums import DW_TAG
+
+
+def source_path(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def compile_test_elf(directory, sources, cflags):
+    path = os.path.join(directory, 'test')
+    try:
+        subprocess.check_call(['gcc'] + cflags + sources + ['-o', path])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return path
+
+
+class CompiledTestCase(unittest.TestCase):
+    # The C files compiled into the ELF file of the tests, and the flags
+    sources = ['test.c']
+    cflags = ['-gdwarf-4', '-O0']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.path = compile_test_elf(cls.directory,
+                                    [source_path(name) for name in cls.sources],
+                                    cls.cflags)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        if self.path is None:
+            self.skipTest('gcc is not available')
+
+
+class PrunedParseTest(CompiledTestCase):
+    def full_offsets(self):
+        cu = DWARF(self.path).info.cus[0]
+        return [die.offset for die in cu.dies]
+
+    def test_pruned_tree_is_partial(self):
+        cu = DWARF(self.path).info.cus[0]
+        tree = cu.parse_dies(prune=[DW_TAG.subprogram])
+        self.assertTrue(tree.partial)
+        self.assertTrue(len(tree.dies) < len(self.full_offsets()))
+        subprograms = [die for die in tree.root.children
+                       if die.tag == DW_TAG.subprogram]
+        self.assertTrue(subprograms)
+        for die in subprograms:
+            self.assertEqual(die.children, [])
+
+    def test_dies_after_pruned_parse(self):
+        cu = DWARF(self.path).info.cus[0]
+        tree = cu.parse_dies(prune=[DW_TAG.subprogram])
+        pruned = tree.root.children
+
+        self.assertEqual([die.offset for die in cu.dies], self.full_offsets())
+        for offset in self.full_offsets():
+            self.assertEqual(cu.dies_dict[offset].offset, offset)
+
+        # The DIEs of the pruned tree still see their own tree
+        self.assertEqual([die.offset for die in pruned],
+                         [die.offset for die in tree.root.children])
+        self.assertEqual(pruned, cu.root.children)
+
+    def test_top_level_dies_keep_full_tree(self):
+        cu = DWARF(self.path).info.cus[0]
+        top_level = cu.top_level_dies()
+        self.assertEqual([die.offset for die in cu.dies], self.full_offsets())
+        self.assertEqual(top_level, cu.root.children)
+        # With the full tree parsed, no pruned tree is built any more
+        self.assertFalse(cu.parse_dies(prune=[DW_TAG.subprogram]).partial)
+
+
+class FunctionBodyPruneTest(CompiledTestCase):
+    sources = ['scopes.c']
+
+    def test_types_in_function_body_keep_members(self):
+        from dwarf_to_c import compile_unit_roots
+        cu = DWARF(self.path).info.cus[0]
+        child, name = next(compile_unit_roots(cu))
+        tree = child.tree
+        self.assertTrue(tree.partial)
+        steps = [die for die in tree.dies if die.tag == DW_TAG.structure_type]
+        self.assertEqual(len(steps), 1)
+        self.assertEqual([die.tag for die in steps[0].children], [DW_TAG.member])
+        # The lexical blocks are pruned
+        for die in tree.dies:
+            if die.tag == DW_TAG.lexical_block:
+                self.assertEqual(die.children, [])
+
+
+class OffsetTest(CompiledTestCase):
+    def test_offsets_match_across_io_modes(self):
+        offsets = []
+        for use_mmap in (False, True):
+            dwarf = DWARF(self.path, use_mmap=use_mmap)
+            offsets.append([(cu.offset, [die.offset for die in cu.dies])
+                            for cu in dwarf.info.cus])
+        self.assertEqual(offsets[0], offsets[1])
+        debug_info = DWARF(self.path).sect_dict['.debug_info']
+        self.assertEqual(offsets[0][0][0], debug_info.offset)
+
+
+if __name__ == '__main__':
+    unittest.main()
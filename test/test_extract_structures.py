@@ -0,0 +1,31 @@
+"""
+extract_structures_json tests, run with src in PYTHONPATH:
+    PYTHONPATH=src python -m unittest discover -s test -p 'test_*.py'
+"""
+import unittest
+
+from extract_structures_json import parse_dwarf
+
+from test_dies import CompiledTestCase
+
+
+class RootsAcrossCUsTest(CompiledTestCase):
+    sources = ['roots_a.c', 'roots_b.c', 'test.c']
+
+    def member_type(self, types, root, member):
+        for member_info in types[root]['members']:
+            if member_info['name'] == member:
+                return types[member_info['type']]
+        self.fail('No member %s in %s' % (member, root))
+
+    def test_anonymous_types_per_cu(self):
+        types = parse_dwarf(self.path, ['A', 'B'])
+        a_s = self.member_type(types, 'A', 's')
+        b_s = self.member_type(types, 'B', 's')
+        self.assertNotEqual(a_s['name'], b_s['name'])
+        self.assertEqual(types[a_s['members'][0]['type']]['encoding'], 'signed')
+        self.assertEqual(types[b_s['members'][0]['type']]['encoding'], 'signed_char')
+
+
+if __name__ == '__main__':
+    unittest.main()
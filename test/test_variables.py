@@ -0,0 +1,44 @@
+"""
+Variable scope tests, run with src in PYTHONPATH:
+    PYTHONPATH=src python -m unittest discover -s test -p 'test_*.py'
+"""
+import unittest
+
+from bintools.dwarf import DWARF
+from bintools.dwarf.enums import DW_TAG
+
+from test_dies import CompiledTestCase, source_path
+
+
+class RangesScopeTest(CompiledTestCase):
+    sources = ['scopes.c']
+
+    def find_die(self, dwarf, name):
+        for cu in dwarf.info.cus:
+            for die in cu.dies:
+                if 'name' in die.attr_dict and die.attr_dict['name'].value == name:
+                    return die
+        self.fail('No DIE named %s' % name)
+
+    def test_ranges_scope_within_subprogram(self):
+        dwarf = DWARF(self.path)
+        block = self.find_die(dwarf, 'repeats').parent
+        self.assertEqual(block.tag, DW_TAG.lexical_block)
+        self.assertTrue('ranges' in block.attr_dict)
+        (low, high), = self.find_die(dwarf, 'sum_doubles').get_pc_ranges()
+        self.assertTrue(block.get_pc_ranges())
+        for block_low, block_high in block.get_pc_ranges():
+            self.assertTrue(low <= block_low < block_high <= high)
+
+    def test_variables_in_ranges_scope(self):
+        dwarf = DWARF(self.path)
+        for i, line in enumerate(open(source_path('scopes.c'))):
+            if 'in the repeats block' in line:
+                break
+        addr = dwarf.get_addr_by_loc(source_path('scopes.c'), i + 1)
+        names = [variable.name for variable, expr in dwarf.get_variables_by_addr(addr)]
+        self.assertEqual(names, ['n', 'step', 's', 'i', 'repeats'])
+
+
+if __name__ == '__main__':
+    unittest.main()